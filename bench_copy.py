@@ -0,0 +1,114 @@
+"""
+Benchmark of the copy backends used by SyncManager._copy_file.
+
+Copies files of several sizes with each FileCopier backend (without fallback) and reports the throughput, so the
+copy_backend and copy_buffer_size project settings can be chosen for a pair of folders. "buffered+hash" is the
+buffered backend hashing the data while copying, as execute_sync does when the hash of the file is not known.
+
+Usage:
+    python bench_copy.py [--src FOLDER] [--dst FOLDER] [--sizes 4K,1M,64M] [--total 256M] [--buffer-size 1M]
+
+Without --src/--dst, a temporary folder is used for both. Point them to the folders of a project to measure
+copies between its filesystems (files named bench_copy_* are created and removed there).
+"""
+import argparse
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from file_copy import FileCopier
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+
+def make_files(folder: str, size: int, count: int) -> list:
+    paths = []
+    block = os.urandom(min(size, 1024 * 1024)) or b""
+    for i in range(count):
+        path = os.path.join(folder, f"bench_copy_src_{format_size(size)}_{i}")
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                remaining -= f.write(block[:remaining])
+        paths.append(path)
+    return paths
+
+
+def copy_all(copier: FileCopier, paths: list, dst_folder: str, hash_data: bool) -> float:
+    start = time.perf_counter()
+    for i, src_path in enumerate(paths):
+        dst_path = os.path.join(dst_folder, f"bench_copy_dst_{i}")
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        with open(src_path, "rb", buffering=0) as fsrc, open(dst_path, "wb", buffering=0) as fdst:
+            copier.copy(fsrc, fdst, hashlib.sha256() if hash_data else None)
+    elapsed = time.perf_counter() - start
+    for i in range(len(paths)):
+        os.remove(os.path.join(dst_folder, f"bench_copy_dst_{i}"))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the FileCopier backends across file sizes")
+    parser.add_argument("--src", help="Folder where the source files are created (default: temporary folder)")
+    parser.add_argument("--dst", help="Folder the files are copied to (default: same as --src)")
+    parser.add_argument("--sizes", default="4K,1M,64M", help="Comma separated file sizes")
+    parser.add_argument("--total", default="256M", help="Approximate amount of data copied per size and backend")
+    parser.add_argument("--buffer-size", default=format_size(FileCopier.DEFAULT_BUFFER_SIZE),
+                        help="Buffer size of the buffered backend")
+    args = parser.parse_args()
+    tmp_dir = None
+    src_folder = args.src
+    if not src_folder:
+        tmp_dir = tempfile.mkdtemp(prefix="bench_copy_")
+        src_folder = tmp_dir
+    dst_folder = args.dst or src_folder
+    buffer_size = parse_size(args.buffer_size)
+    total = parse_size(args.total)
+    backends = FileCopier.available_backends()
+    try:
+        print(f"Copying \"{src_folder}\" -> \"{dst_folder}\", buffer size {format_size(buffer_size)}")
+        print(f"{'size':>6} {'files':>6}  " + "  ".join(f"{name:>16}" for name in backends + ["buffered+hash"]))
+        for size in (parse_size(size) for size in args.sizes.split(",")):
+            count = max(1, min(total // max(size, 1), 10_000))
+            paths = make_files(src_folder, size, count)
+            results = []
+            for backend in backends + ["buffered+hash"]:
+                copier = FileCopier(backend.split("+")[0], buffer_size, fallback=False)
+                try:
+                    copy_all(copier, paths[:1], dst_folder, False)  # Warm up, and fail fast if unsupported
+                    elapsed = copy_all(copier, paths, dst_folder, backend.endswith("+hash"))
+                    results.append(f"{size * count / elapsed / UNITS['M']:>11.1f} MB/s")
+                except OSError as e:
+                    results.append(f"{'n/a ' + errno.errorcode.get(e.errno, 'error'):>16}")
+                    for i in range(len(paths)):
+                        dst_path = os.path.join(dst_folder, f"bench_copy_dst_{i}")
+                        if os.path.exists(dst_path):
+                            os.remove(dst_path)
+            print(f"{format_size(size):>6} {count:>6}  " + "  ".join(results))
+            for path in paths:
+                os.remove(path)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
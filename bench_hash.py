@@ -0,0 +1,118 @@
+"""
+Benchmark of the file hashing paths used by FileHasher.
+
+Hashes files of several sizes with each read strategy and reports the throughput, so the hash_buffer_size and
+hash_mmap_threshold project settings can be chosen for a folder:
+- "read8k": f.read(8192) in a loop, how FolderTracker used to hash files.
+- "read": f.read(hash_buffer_size) in a loop, a new bytes object per call.
+- "readinto": FileHasher without mmap, reading into a reused buffer.
+- "mmap": FileHasher with every file memory-mapped.
+With --algos, the hash functions and modes (the hash_function and hash_mode settings) are compared instead.
+
+Usage:
+    python bench_hash.py [--folder FOLDER] [--sizes 4K,1M,256M] [--total 512M] [--buffer-size 1M] [--algos]
+
+Without --folder, a temporary folder is used. Files named bench_hash_* are created and removed there. The files
+were just written, so the results measure the CPU cost of hashing from the page cache rather than the disk.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from bench_copy import UNITS, format_size, parse_size
+from file_hash import FileHasher
+
+
+def hash_read(path: str, buffer_size: int) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(buffer_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def make_methods(buffer_size: int) -> dict:
+    readinto = FileHasher("flat", buffer_size)
+    mapped = FileHasher("flat", buffer_size, mmap_threshold=1)
+    return {
+        "read8k": lambda path: hash_read(path, 8192),
+        "read": lambda path: hash_read(path, buffer_size),
+        "readinto": readinto.hash_file,
+        "mmap": mapped.hash_file,
+    }
+
+
+def make_algo_methods(buffer_size: int) -> dict:
+    methods = {}
+    for function in FileHasher.FUNCTIONS:
+        for mode in FileHasher.MODES:
+            methods[f"{function}/{mode}"] = FileHasher(mode, buffer_size, function=function).hash_file
+    return methods
+
+
+def make_files(folder: str, size: int, count: int) -> list:
+    paths = []
+    block = os.urandom(min(size, 1024 * 1024))
+    for i in range(count):
+        path = os.path.join(folder, f"bench_hash_{format_size(size)}_{i}")
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                remaining -= f.write(block[:remaining])
+        paths.append(path)
+    return paths
+
+
+def hash_all(method, paths: list) -> tuple:
+    start = time.perf_counter()
+    hashes = [method(path) for path in paths]
+    return time.perf_counter() - start, hashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the file hashing paths across file sizes")
+    parser.add_argument("--folder", help="Folder where the files are created (default: temporary folder)")
+    parser.add_argument("--sizes", default="4K,1M,256M", help="Comma separated file sizes")
+    parser.add_argument("--total", default="512M", help="Approximate amount of data hashed per size and method")
+    parser.add_argument("--buffer-size", default=format_size(FileHasher.DEFAULT_BUFFER_SIZE),
+                        help="Read size of the read, readinto and mmap methods")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions, the best one is reported")
+    parser.add_argument("--algos", action="store_true", help="Compare the hash functions and modes")
+    args = parser.parse_args()
+    tmp_dir = None
+    folder = args.folder
+    if not folder:
+        tmp_dir = tempfile.mkdtemp(prefix="bench_hash_")
+        folder = tmp_dir
+    buffer_size = parse_size(args.buffer_size)
+    total = parse_size(args.total)
+    methods = make_algo_methods(buffer_size) if args.algos else make_methods(buffer_size)
+    try:
+        print(f"Hashing in \"{folder}\", buffer size {format_size(buffer_size)}")
+        print(f"{'size':>6} {'files':>6}  " + "  ".join(f"{name:>14}" for name in methods))
+        for size in (parse_size(size) for size in args.sizes.split(",")):
+            count = max(1, min(total // max(size, 1), 100_000))
+            paths = make_files(folder, size, count)
+            expected = None
+            results = []
+            for name, method in methods.items():
+                method(paths[0])  # Warm up
+                elapsed, hashes = min(hash_all(method, paths) for _ in range(max(args.repeat, 1)))
+                if expected is None:
+                    expected = hashes
+                elif (hashes != expected) and not args.algos:
+                    raise RuntimeError(f"Method \"{name}\" produced different hashes")
+                results.append(f"{size * count / elapsed / UNITS['M']:>9.1f} MB/s")
+            print(f"{format_size(size):>6} {count:>6}  " + "  ".join(results))
+            for path in paths:
+                os.remove(path)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
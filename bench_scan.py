@@ -0,0 +1,155 @@
+"""
+Benchmark of the folder walker used by SyncManager.scan_folder.
+
+Compares the legacy os.walk + os.path.* walker with SyncManager.walk_folder (os.scandir, one stat per entry),
+reporting the number of filesystem calls made from Python and the elapsed time. Hashing is left out so only the
+metadata cost is measured.
+
+Usage:
+    python bench_scan.py [folder] [--files N] [--dirs N] [--repeat N]
+
+Without a folder, a temporary tree with the given number of folders and files is generated.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+from sync_manager import SyncManager
+
+
+class CallCounter:
+    """Counts calls to os.stat, os.lstat, os.scandir and DirEntry.stat while active."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._originals = {}
+
+    def __enter__(self):
+        for name in ("stat", "lstat", "scandir"):
+            self._originals[name] = getattr(os, name)
+        counter = self.counts
+        original_stat, original_lstat, original_scandir = (self._originals[name] for name in ("stat", "lstat", "scandir"))
+
+        class CountingEntry:
+            def __init__(self, entry):
+                self._entry = entry
+
+            def __getattr__(self, item):
+                return getattr(self._entry, item)
+
+            def stat(self, *args, **kwargs):
+                counter["DirEntry.stat"] += 1
+                return self._entry.stat(*args, **kwargs)
+
+        class CountingScandir:
+            def __init__(self, it):
+                self._it = it
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                return CountingEntry(next(self._it))
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                self._it.close()
+
+        def counting_stat(*args, **kwargs):
+            counter["os.stat"] += 1
+            return original_stat(*args, **kwargs)
+
+        def counting_lstat(*args, **kwargs):
+            counter["os.lstat"] += 1
+            return original_lstat(*args, **kwargs)
+
+        def counting_scandir(*args, **kwargs):
+            counter["os.scandir"] += 1
+            return CountingScandir(original_scandir(*args, **kwargs))
+
+        os.stat, os.lstat, os.scandir = counting_stat, counting_lstat, counting_scandir
+        return self
+
+    def __exit__(self, *exc):
+        for name, func in self._originals.items():
+            setattr(os, name, func)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+def legacy_scan(folder: str) -> dict:
+    # The walker scan_folder used before walk_folder: os.walk plus separate os.path calls per entry
+    fmap = {}
+    for root, dirs, files in os.walk(folder):
+        for local_name in dirs + files:
+            full_path = os.path.join(root, local_name)
+            rel_path = os.path.relpath(full_path, folder)
+            fmap[rel_path] = {
+                "type": "folder" if os.path.isdir(full_path) else "file",
+                "ctime": os.path.getctime(full_path),
+                "mtime": os.path.getmtime(full_path),
+                "hash": None if os.path.isfile(full_path) else rel_path,
+                "size": os.path.getsize(full_path) if os.path.isfile(full_path) else 0,
+            }
+    return fmap
+
+
+def scandir_scan(folder: str) -> dict:
+    return SyncManager.scan_folder(folder, hash_files=False)
+
+
+def make_tree(root: str, n_dirs: int, n_files: int):
+    dirs = [root]
+    for i in range(n_dirs):
+        path = os.path.join(dirs[i // 4], f"dir{i}")  # Up to 4 sub folders per folder
+        os.makedirs(path)
+        dirs.append(path)
+    for i in range(n_files):
+        with open(os.path.join(dirs[i % len(dirs)], f"file{i}.txt"), "wb") as f:
+            f.write(b"x" * (i % 1024))
+
+
+def run(label: str, func, folder: str, repeat: int):
+    with CallCounter() as counter:
+        func(folder)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fmap = func(folder)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    calls = ", ".join(f"{name}={count}" for name, count in sorted(counter.counts.items()))
+    print(f"{label:<10} entries={len(fmap):<8} calls={counter.total:<8} ({calls})  best={best * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the legacy os.walk walker with SyncManager.walk_folder")
+    parser.add_argument("folder", nargs="?", help="Folder to scan (default: generated temporary tree)")
+    parser.add_argument("--dirs", type=int, default=200, help="Folders in the generated tree")
+    parser.add_argument("--files", type=int, default=5000, help="Files in the generated tree")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions, the best one is reported")
+    args = parser.parse_args()
+    tmp_dir = None
+    folder = args.folder
+    if not folder:
+        tmp_dir = tempfile.mkdtemp(prefix="bench_scan_")
+        make_tree(tmp_dir, args.dirs, args.files)
+        folder = tmp_dir
+    try:
+        print(f"Scanning \"{folder}\"")
+        run("os.walk", legacy_scan, folder, args.repeat)
+        run("scandir", scandir_scan, folder, args.repeat)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Command line interface of FolderTracker, for scheduled syncs on machines without a display.
+
+Usage:
+    python cli.py list
+    python cli.py prep (--all | PROJECT...) [--verbose] [--json]
+    python cli.py sync (--all | PROJECT...) [--conflict POLICY] [--verbose] [--json]
+    python cli.py schedule (--all | PROJECT...) [--conflict POLICY] [--workers N] [--device-limit N] [--once] [--json]
+
+"prep" scans the folders and prints the sync actions without changing anything. "sync" also runs them and saves
+the projects. "sync" resumes an interrupted sync of a project (see SyncJournal) before preparing the project again,
+"prep" only reports it as pending.
+"schedule" syncs the projects concurrently with SyncScheduler, again every schedule_interval seconds of each project
+unless --once is given, and prints a summary per project when it ends (or is interrupted with Ctrl+C).
+Conflicts are resolved with the --conflict policy, by default the conflict_policy setting of each project:
+- "both" (default setting): keep both versions, renamed, like the UI does by default.
+- "a" / "b": keep the version of folder A / B.
+- "newer": keep the version modified last.
+- "skip": leave the conflicting files out of the sync, they are reported again next time.
+- "fail": do not sync a project that has conflicts.
+
+Exit status: 0 on success, 1 if a project failed, 2 on a usage error (unknown project), 3 if a project was not
+synced because of conflicts (--conflict fail) and 130 if interrupted with Ctrl+C.
+
+This module does not import tkinter or PIL, so it can run on servers without them.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+from project_manager import CONFLICT_POLICIES, ProjectManager
+from scheduler import SyncScheduler
+
+EXIT_OK, EXIT_FAILED, EXIT_USAGE, EXIT_CONFLICTS, EXIT_INTERRUPTED = 0, 1, 2, 3, 130
+
+logger = logging.getLogger("SYNC")
+
+
+def run_cancellable(project, func):
+    """
+    Run `func` in a worker thread so Ctrl+C can cancel the project operation cleanly (copies in progress complete
+    or are rolled back, the sync journal is kept) instead of interrupting it at a random point.
+    """
+    result = {}
+
+    def worker():
+        try:
+            result["value"] = func()
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=worker, name="cli", daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(0.2)
+    except KeyboardInterrupt:
+        project.cancel()
+        thread.join()
+        raise
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def process_project(project, command: str, policy: str, verbose: bool) -> dict:
+    """Prepare (and for "sync", run) the sync of a project and return its report."""
+    report = {"project": project.project_name, "status": "ok"}
+    if project.get_interrupted_sync():
+        if command != "sync":
+            report["interrupted"] = True  # Resuming it would change the folders
+        else:
+            logger.info(f"Resuming the interrupted sync of project \"{project.project_name}\"")
+            run_cancellable(project, project.resume_sync)
+            report["resumed"] = True
+    run_cancellable(project, project.prep_sync)
+    report["prep"] = project.get_last_run_summary()
+    sync_actions = project.get_sync_actions() or {}
+    report["conflicts"] = len(project.get_conflicts())
+    policy = policy or project.conflict_policy
+    if command == "sync" and report["conflicts"]:
+        if policy == "fail":
+            report["status"] = "conflicts"
+        else:
+            project.resolve_conflicts(policy)
+    report["actions"] = project.count_actions()
+    if verbose:
+        report["details"] = {rel_path: action for rel_path, action in sorted(sync_actions.items())
+                             if action != "no action"}
+    if command == "sync" and report["status"] == "ok" and report["actions"]:
+        run_cancellable(project, project.execute_sync)
+        report["sync"] = project.get_last_run_summary()
+    return report
+
+
+def print_report(report: dict):
+    actions = ", ".join(f"{count} {action}" for action, count in sorted(report.get("actions", {}).items()))
+    status = report["status"]
+    if status == "ok":
+        status = "synced" if "sync" in report else ("up to date" if not report.get("actions") else "prepared")
+    print(f"{report['project']}: {status}" + (f" ({actions})" if actions else ""))
+    if report.get("interrupted"):
+        print("    an interrupted sync is pending, \"sync\" resumes it")
+    for rel_path, action in report.get("details", {}).items():
+        print(f"    {action}: {rel_path}")
+    if report.get("error"):
+        print(f"    error: {report['error']}")
+
+
+def print_summary(summary: dict):
+    for name, total in sorted(summary.items()):
+        print(f"{name}: {total['runs']} runs, {total['failed']} failed, {total['seconds']:.1f} s, "
+              f"{total['bytes']} bytes copied, last {total['status']}")
+
+
+def schedule(projects: list, args) -> int:
+    """Run the projects with SyncScheduler until every one synced once (--once) or Ctrl+C."""
+    scheduler = SyncScheduler(args.workers, args.device_limit, conflict_policy=args.conflict)
+    for project in projects:
+        scheduler.add(project)
+    thread = threading.Thread(target=scheduler.run, args=(args.once,), name="scheduler", daemon=True)
+    thread.start()
+    exit_code = EXIT_OK
+    try:
+        while thread.is_alive():
+            thread.join(0.2)
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        scheduler.stop()
+        thread.join()
+        exit_code = EXIT_INTERRUPTED
+    runs = scheduler.report()
+    if args.json:
+        print(json.dumps({"runs": runs, "summary": scheduler.summary()}, indent=4))
+    else:
+        print_summary(scheduler.summary())
+    if exit_code == EXIT_OK:
+        statuses = {run["status"] for run in runs}
+        exit_code = EXIT_FAILED if statuses - {"ok", "conflicts"} else (EXIT_CONFLICTS if "conflicts" in statuses
+                                                                        else EXIT_OK)
+    return exit_code
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py", description="Prepare and run FolderTracker syncs without the UI")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only log warnings and errors")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List the projects")
+    for command, description in (("prep", "Scan the folders and show the sync actions"),
+                                 ("sync", "Scan the folders and run the sync actions"),
+                                 ("schedule", "Sync the projects concurrently, repeatedly at their intervals")):
+        subparser = subparsers.add_parser(command, help=description)
+        subparser.add_argument("projects", nargs="*", metavar="PROJECT", help="Project names")
+        subparser.add_argument("--all", action="store_true", help="All the projects")
+        if command != "schedule":
+            subparser.add_argument("-v", "--verbose", action="store_true", help="List every action")
+        subparser.add_argument("--json", action="store_true", help="Print the reports as JSON")
+        if command in ("sync", "schedule"):
+            subparser.add_argument("--conflict", choices=CONFLICT_POLICIES,
+                                   help="How to resolve conflicts (default: the conflict_policy of each project)")
+        if command == "schedule":
+            subparser.add_argument("--workers", type=int, default=4, help="Projects synced at the same time")
+            subparser.add_argument("--device-limit", type=int, default=1,
+                                   help="Projects synced at the same time on one disk or share")
+            subparser.add_argument("--once", action="store_true", help="Sync every project once, then exit")
+    return parser
+
+
+def main(argv: list = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if (args.command != "list") and (args.all == bool(args.projects)):
+        parser.error("give project names or --all")
+    if args.quiet:
+        logger.setLevel(logging.WARNING)
+    project_manager = ProjectManager()
+    try:
+        project_manager.load_projects()
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return EXIT_USAGE
+    if args.command == "list":
+        for project in sorted(project_manager.projects, key=lambda project: project.project_name):
+            print(f"{project.project_name}: \"{project.folder_a}\" <-> \"{project.folder_b}\"")
+        return EXIT_OK
+    if args.all:
+        projects = sorted(project_manager.projects, key=lambda project: project.project_name)
+    else:
+        projects = []
+        for name in args.projects:
+            project = project_manager.get_project_by_name(name)
+            if project is None:
+                print(f"Unknown project: {name}", file=sys.stderr)
+                return EXIT_USAGE
+            projects.append(project)
+    if args.command == "schedule":
+        return schedule(projects, args)
+    exit_code = EXIT_OK
+    reports = []
+    try:
+        for project in projects:
+            try:
+                report = process_project(project, args.command, getattr(args, "conflict", None), args.verbose)
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                logger.error(f"Error processing project \"{project.project_name}\": {str(e)}")
+                report = {"project": project.project_name, "status": "failed", "error": str(e)}
+            if report["status"] == "failed":
+                exit_code = EXIT_FAILED
+            elif (report["status"] == "conflicts") and (exit_code == EXIT_OK):
+                exit_code = EXIT_CONFLICTS
+            reports.append(report)
+            if not args.json:
+                print_report(report)
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        exit_code = EXIT_INTERRUPTED
+    if args.json:
+        print(json.dumps(reports, indent=4))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import errno
+import logging
+import os
+import sys
+
+logger = logging.getLogger("SYNC")
+
+# Errors meaning a backend cannot be used for this pair of files, the next one is tried instead
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY,
+                       errno.EBADF, errno.EPERM, errno.ETXTBSY}
+
+
+class FileCopier:
+    """
+    Copies the data of a file with the fastest backend available.
+
+    Backends, tried in this order by "auto":
+    - "reflink": clone the file (FICLONE ioctl), the data is shared until modified (Btrfs, XFS, ...).
+    - "copy_file_range": in-kernel copy, which some filesystems offload to the storage or the server.
+    - "sendfile": in-kernel copy for systems without copy_file_range.
+    - "buffered": read and write through a user space buffer of `buffer_size` bytes. It is the only backend that
+      sees the data, so it is the only one that can hash the file while copying it.
+    A backend that fails before copying any data falls back to the next one ("buffered" for an explicit backend)
+    unless `fallback` is False, and is not tried again for the same pair of devices. The same goes for a kernel
+    backend whose copy does not have the size of the source, the file is then copied again buffered.
+
+    Files of at least `delta_threshold` bytes that already exist at the destination can instead be updated in place
+    with patch(), which only writes the blocks of `delta_block_size` bytes that differ.
+    """
+    BACKENDS = ("auto", "reflink", "copy_file_range", "sendfile", "buffered")
+    HASHING_BACKENDS = ("buffered", "delta")
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+    DEFAULT_DELTA_BLOCK_SIZE = 1024 * 1024
+    FICLONE = 0x40049409
+
+    def __init__(self, backend: str = "auto", buffer_size: int = DEFAULT_BUFFER_SIZE, fallback: bool = True,
+                 delta_threshold: int = None, delta_block_size: int = DEFAULT_DELTA_BLOCK_SIZE):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Invalid copy backend: {backend}")
+        self.backend = backend
+        self.buffer_size = max(int(buffer_size or self.DEFAULT_BUFFER_SIZE), 4096)
+        self.fallback = fallback
+        self.delta_threshold = delta_threshold
+        self.delta_block_size = max(int(delta_block_size or self.DEFAULT_DELTA_BLOCK_SIZE), 4096)
+        self._unsupported = set()  # (backend, src_dev, dst_dev)
+
+    @classmethod
+    def available_backends(cls) -> list:
+        backends = []
+        if sys.platform.startswith("linux"):
+            backends.append("reflink")
+        if hasattr(os, "copy_file_range"):
+            backends.append("copy_file_range")
+        if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+            backends.append("sendfile")  # Other systems only support sendfile to sockets
+        backends.append("buffered")
+        return backends
+
+    def _chain(self) -> list:
+        if self.backend == "auto":
+            return self.available_backends()
+        if not self.fallback or self.backend == "buffered":
+            return [self.backend]
+        return [self.backend, "buffered"]
+
+    def copy(self, fsrc, fdst, hasher=None) -> str:
+        """
+        Copy the data of the open file `fsrc` to the open, empty file `fdst` and return the name of the backend used.
+
+        `hasher` (a hashlib object) is updated with the data only by the "buffered" backend.
+        """
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+        chain = self._chain()
+        for backend in chain:
+            if (backend, *devices) in self._unsupported:
+                continue
+            try:
+                getattr(self, f"_copy_{backend}")(src_fd, dst_fd, hasher)
+            except OSError as e:
+                if (e.errno not in _UNSUPPORTED_ERRNOS) or (backend == "buffered") or (backend == chain[-1]):
+                    raise
+                if os.lseek(dst_fd, 0, os.SEEK_END) > 0:
+                    raise  # Failed half way, this is not a missing feature
+                logger.debug(f"Copy backend \"{backend}\" not supported from device {devices[0]} to {devices[1]}, "
+                             f"falling back. Error: {str(e)}")
+                self._unsupported.add((backend, *devices))
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                continue
+            if backend == "buffered":
+                return backend
+            # The kernel backends stop when the kernel reports the end of the data, which some filesystems do too
+            # early (copy_file_range returning 0 at once), and a short copy would get the hash of the full file
+            src_size, dst_size = os.fstat(src_fd).st_size, os.fstat(dst_fd).st_size
+            if dst_size == src_size:
+                return backend
+            self._unsupported.add((backend, *devices))
+            if "buffered" not in chain:
+                raise OSError(errno.EIO, f"Copy backend \"{backend}\" copied {dst_size} of {src_size} bytes")
+            logger.warning(f"Copy backend \"{backend}\" copied {dst_size} of {src_size} bytes from device "
+                           f"{devices[0]} to {devices[1]}, copying buffered instead")
+            os.ftruncate(dst_fd, 0)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            self._copy_buffered(src_fd, dst_fd, hasher)
+            return "buffered"
+        raise OSError(errno.ENOTSUP, f"No copy backend available (backend \"{self.backend}\")")
+
+    def use_delta(self, src_size: int, dst_path: str) -> bool:
+        """Return True if a file of `src_size` bytes should be patched into the existing file `dst_path`."""
+        return (self.delta_threshold is not None) and (src_size >= self.delta_threshold) and os.path.isfile(dst_path)
+
+    def patch(self, fsrc, fdst, hasher=None) -> int:
+        """
+        Update the open file `fdst` in place to the content of `fsrc` and return the number of bytes written.
+
+        Both files are compared block by block at the same offsets, which finds the changes of files that are
+        appended to or modified in place, and only the blocks that differ are written. The destination is then
+        truncated to the size of the source. `hasher` is updated with all the data of the source.
+        """
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        offset = written = 0
+        while src_block := os.read(src_fd, self.delta_block_size):
+            if hasher is not None:
+                hasher.update(src_block)
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            if os.read(dst_fd, len(src_block)) != src_block:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                view = memoryview(src_block)
+                while view:
+                    view = view[os.write(dst_fd, view):]
+                written += len(src_block)
+            offset += len(src_block)
+        os.ftruncate(dst_fd, offset)
+        return written
+
+    def _copy_reflink(self, src_fd: int, dst_fd: int, hasher=None):
+        import fcntl
+        fcntl.ioctl(dst_fd, self.FICLONE, src_fd)
+
+    def _copy_copy_file_range(self, src_fd: int, dst_fd: int, hasher=None):
+        while os.copy_file_range(src_fd, dst_fd, self.buffer_size * 64):
+            pass
+
+    def _copy_sendfile(self, src_fd: int, dst_fd: int, hasher=None):
+        offset = 0
+        while sent := os.sendfile(dst_fd, src_fd, offset, self.buffer_size * 64):
+            offset += sent
+
+    def _copy_buffered(self, src_fd: int, dst_fd: int, hasher=None):
+        while chunk := os.read(src_fd, self.buffer_size):
+            if hasher is not None:
+                hasher.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(dst_fd, view):]
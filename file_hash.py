@@ -0,0 +1,233 @@
+import hashlib
+import mmap
+import os
+
+
+class FileHasher:
+    """
+    Computes the content hash of files with the hash `function` ("sha256" or "blake2b").
+
+    - mode "flat": digest of the whole content, the hash FolderTracker has always used.
+    - mode "tree": the content is split in blocks of `block_size` bytes and the file hash is the digest of the
+      concatenated block digests. The block digests are kept in the hash cache and, with `detect_appends`, a file
+      that was only appended to since it was cached only needs its new blocks hashed.
+    - mode "sample": digest of the size, the first and the last `sample_size` bytes of the file. It reads at most
+      twice `sample_size` bytes per file but does not see changes in the middle of larger files.
+    Files are read `buffer_size` bytes at a time with readinto() into a reused buffer, and files of at least
+    `mmap_threshold` bytes are memory-mapped instead; either way the hash function is fed memoryview slices without
+    copying the data. The `algo` string names the hash function and mode; it is recorded with every hash so hashes of
+    different kinds are never compared with each other.
+    """
+    MODES = ("flat", "tree", "sample")
+    FUNCTIONS = ("sha256", "blake2b")
+    DEFAULT_ALGO = "sha256"
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+    DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+    DEFAULT_SAMPLE_SIZE = 64 * 1024
+
+    def __init__(self, mode: str = "flat", buffer_size: int = DEFAULT_BUFFER_SIZE, block_size: int = DEFAULT_BLOCK_SIZE,
+                 detect_appends: bool = False, mmap_threshold: int = None, function: str = "sha256",
+                 sample_size: int = DEFAULT_SAMPLE_SIZE):
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid hash mode: {mode}")
+        if function not in self.FUNCTIONS:
+            raise ValueError(f"Invalid hash function: {function}")
+        self.mode = mode
+        self.function = function
+        self.buffer_size = max(int(buffer_size or self.DEFAULT_BUFFER_SIZE), 4096)
+        self.block_size = max(int(block_size or self.DEFAULT_BLOCK_SIZE), 4096)
+        self.sample_size = max(int(sample_size or self.DEFAULT_SAMPLE_SIZE), 4096)
+        self.detect_appends = detect_appends
+        self.mmap_threshold = mmap_threshold
+
+    @property
+    def algo(self) -> str:
+        if self.mode == "tree":
+            return f"{self.function}-tree-{self.block_size}"
+        if self.mode == "sample":
+            return f"{self.function}-sample-{self.sample_size}"
+        return self.function
+
+    @classmethod
+    def from_algo(cls, algo: str, buffer_size: int = DEFAULT_BUFFER_SIZE, mmap_threshold: int = None):
+        """Return a hasher producing hashes of kind `algo`, or None if the kind is unknown."""
+        function, _, mode_size = (algo or cls.DEFAULT_ALGO).partition("-")
+        mode, _, size = mode_size.partition("-")
+        if function not in cls.FUNCTIONS:
+            return None
+        if not mode_size:
+            return cls("flat", buffer_size, mmap_threshold=mmap_threshold, function=function)
+        if (mode == "tree") and size.isdigit():
+            return cls("tree", buffer_size, int(size), mmap_threshold=mmap_threshold, function=function)
+        if (mode == "sample") and size.isdigit():
+            return cls("sample", buffer_size, function=function, sample_size=int(size))
+        return None
+
+    def new(self):
+        return getattr(hashlib, self.function)()
+
+    def hash_file(self, file_path: str) -> str:
+        if self.mode == "tree":
+            return self.hash_blocks(file_path)[0]
+        if self.mode == "sample":
+            return self._hash_sample(file_path)
+        hasher = self.new()
+        with open(file_path, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            if self._use_mmap(size):
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    self._feed_mapped(hasher, mapped, 0, len(mapped))
+            else:
+                self._feed(hasher, f, self._buffer(size))
+        return hasher.hexdigest()
+
+    def _hash_sample(self, file_path: str) -> str:
+        hasher = self.new()
+        with open(file_path, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            hasher.update(size.to_bytes(8, "little"))
+            buffer = self._buffer(min(size, self.sample_size))
+            self._feed(hasher, f, buffer, self.sample_size)
+            # The tail starts after the head, so files up to twice the sample size are hashed in full
+            f.seek(max(size - self.sample_size, self.sample_size))
+            self._feed(hasher, f, buffer, self.sample_size)
+        return hasher.hexdigest()
+
+    def _use_mmap(self, size: int) -> bool:
+        return (self.mmap_threshold is not None) and (size > 0) and (size >= self.mmap_threshold)
+
+    def _buffer(self, size: int) -> memoryview:
+        # No larger than needed to read a small file in one call (plus one byte to see the end of the file)
+        return memoryview(bytearray(max(min(self.buffer_size, size + 1), 1)))
+
+    @staticmethod
+    def _feed(hasher, f, buffer: memoryview, limit: int = None) -> int:
+        """Feed `hasher` with the data of the unbuffered file `f` up to `limit` bytes or EOF, return the bytes read."""
+        total = 0
+        while (limit is None) or (total < limit):
+            size = f.readinto(buffer if limit is None else buffer[:min(len(buffer), limit - total)])
+            if not size:
+                break
+            hasher.update(buffer[:size])
+            total += size
+        return total
+
+    def _feed_mapped(self, hasher, mapped: mmap.mmap, start: int, end: int):
+        with memoryview(mapped) as view:
+            for offset in range(start, end, self.buffer_size):
+                with view[offset:min(offset + self.buffer_size, end)] as chunk:
+                    hasher.update(chunk)
+
+    def hash_blocks(self, file_path: str, known_blocks: list = None, known_size: int = 0) -> tuple:
+        """
+        Return (hash, block digests) of a file in tree mode.
+
+        `known_blocks` are the block digests of an earlier version of the file of `known_size` bytes, which is
+        assumed to have been appended to: its complete blocks are reused if the last of them is unchanged, and only
+        the following blocks are read.
+        """
+        blocks = []
+        start = 0
+        with open(file_path, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._use_mmap(size) else None
+            buffer = None if mapped is not None else self._buffer(min(size, self.block_size))
+            try:
+                reusable = min(len(known_blocks or []), known_size // self.block_size)
+                if reusable and (self._hash_block(f, buffer, mapped, (reusable - 1) * self.block_size) ==
+                                 known_blocks[reusable - 1]):
+                    blocks = list(known_blocks[:reusable])
+                    start = reusable * self.block_size
+                offset = start
+                while (digest := self._hash_block(f, buffer, mapped, offset)) is not None:
+                    blocks.append(digest)
+                    offset += self.block_size
+            finally:
+                if mapped is not None:
+                    mapped.close()
+        return self.tree_digest(blocks), blocks
+
+    def _hash_block(self, f, buffer: memoryview, mapped: mmap.mmap, offset: int):
+        """Return the digest of the block starting at `offset`, or None past the end of the file."""
+        hasher = self.new()
+        if mapped is not None:
+            end = min(offset + self.block_size, len(mapped))
+            if offset >= end:
+                return None
+            self._feed_mapped(hasher, mapped, offset, end)
+            return hasher.hexdigest()
+        f.seek(offset)
+        return hasher.hexdigest() if self._feed(hasher, f, buffer, self.block_size) else None
+
+    def tree_digest(self, blocks: list) -> str:
+        hasher = self.new()
+        for block in blocks:
+            hasher.update(bytes.fromhex(block))
+        return hasher.hexdigest()
+
+    def stream(self):
+        """Return an object with update() and hexdigest() giving this hasher's hash of the data fed to it."""
+        if self.mode == "tree":
+            return TreeStream(self)
+        if self.mode == "sample":
+            return SampleStream(self)
+        return self.new()
+
+
+class TreeStream:
+    """Incremental tree hash, for data that is hashed while it is copied."""
+
+    def __init__(self, hasher: FileHasher):
+        self._hasher = hasher
+        self._block = hasher.new()
+        self._filled = 0
+        self._blocks = []
+
+    def update(self, data):
+        view = memoryview(data)
+        block_size = self._hasher.block_size
+        while view:
+            size = min(len(view), block_size - self._filled)
+            self._block.update(view[:size])
+            self._filled += size
+            view = view[size:]
+            if self._filled == block_size:
+                self._blocks.append(self._block.hexdigest())
+                self._block = self._hasher.new()
+                self._filled = 0
+
+    @property
+    def blocks(self) -> list:
+        return self._blocks + ([self._block.hexdigest()] if self._filled else [])
+
+    def hexdigest(self) -> str:
+        return self._hasher.tree_digest(self.blocks)
+
+
+class SampleStream:
+    """Incremental sample hash, keeps the head and the last bytes seen until hexdigest() is called."""
+
+    def __init__(self, hasher: FileHasher):
+        self._hasher = hasher
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        sample_size = self._hasher.sample_size
+        if len(self._head) < sample_size:
+            size = min(len(view), sample_size - len(self._head))
+            self._head += view[:size]
+            view = view[size:]
+        self._size += len(data)
+        if view:
+            self._tail += view[-sample_size:]
+            del self._tail[:-sample_size]
+
+    def hexdigest(self) -> str:
+        hasher = self._hasher.new()
+        hasher.update(self._size.to_bytes(8, "little"))
+        hasher.update(self._head)
+        hasher.update(self._tail)
+        return hasher.hexdigest()
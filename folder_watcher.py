@@ -0,0 +1,378 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+
+logger = logging.getLogger("SYNC")
+
+
+class ChangeJournal:
+    """
+    Thread-safe record of the paths changed in a folder since the journal was last drained.
+
+    Paths are relative to the watched folder. Folders recorded with record_folder() must have their whole subtree
+    rescanned (e.g. a folder moved in, or a folder that could not be watched). An overflow means the journal can no
+    longer be trusted and the folder must be fully rescanned.
+    """
+    DEFAULT_MAX_PATHS = 100_000
+
+    def __init__(self, max_paths: int = DEFAULT_MAX_PATHS):
+        self._lock = threading.Lock()
+        self._max_paths = max_paths
+        self._paths = {}
+        self._folders = set()
+        self._overflow = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._paths) + len(self._folders)
+
+    @property
+    def overflow(self):
+        with self._lock:
+            return self._overflow
+
+    def record(self, rel_path: str, event: str):
+        """Record a "created", "modified", "deleted" or "moved" event for `rel_path`."""
+        with self._lock:
+            if self._overflow:
+                return
+            self._paths[rel_path] = event
+            if len(self._paths) > self._max_paths:
+                self._set_overflow(f"more than {self._max_paths} changed paths")
+
+    def record_folder(self, rel_path: str):
+        with self._lock:
+            if not self._overflow:
+                self._folders.add(rel_path)
+
+    def record_overflow(self, reason: str = ""):
+        with self._lock:
+            self._set_overflow(reason)
+
+    def _set_overflow(self, reason: str):
+        if not self._overflow:
+            logger.info(f"Change journal overflowed{': ' + reason if reason else ''}, a full rescan is required")
+        self._overflow = True
+        self._paths = {}
+        self._folders = set()
+
+    def drain(self) -> dict:
+        """Return the recorded changes as {"paths": {rel_path: event}, "folders": set, "overflow": bool} and reset."""
+        with self._lock:
+            changes = {"paths": self._paths, "folders": self._folders, "overflow": self._overflow}
+            self._paths = {}
+            self._folders = set()
+            self._overflow = False
+            return changes
+
+
+class FolderWatcher:
+    """Base class of the watchers, records the changes below `folder` into `journal` from a background thread."""
+
+    def __init__(self, folder: str, journal: ChangeJournal):
+        self.folder = folder
+        self.journal = journal
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run_safe, name=f"watch:{self.folder}", daemon=True)
+        self._thread.start()
+        logger.debug(f"{type(self).__name__} started: \"{self.folder}\"")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+        logger.debug(f"{type(self).__name__} stopped: \"{self.folder}\"")
+
+    def flush(self):
+        """Record the changes that already happened but were not processed by the background thread yet."""
+        raise NotImplementedError
+
+    def _run_safe(self):
+        try:
+            self._run()
+        except Exception as e:
+            logger.error(f"Folder watcher failed for \"{self.folder}\", falling back to full scans. Error: {str(e)}")
+            self.journal.record_overflow("watcher stopped")
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class PollingWatcher(FolderWatcher):
+    """
+    Portable watcher that compares the (type, size, mtime) of every entry every `interval` seconds.
+
+    Each pass stats every entry of the tree, so it costs about as much as a scan of a folder whose hashes are all
+    cached. The wait doubles after every pass that finds no change, up to `max_interval` seconds, and goes back to
+    `interval` once a change is found. flush() runs a pass at once, so a scan never misses a change however long
+    the wait is.
+    """
+    DEFAULT_INTERVAL = 30.0
+    DEFAULT_MAX_INTERVAL = 300.0
+
+    def __init__(self, folder: str, journal: ChangeJournal, interval: float = DEFAULT_INTERVAL,
+                 max_interval: float = DEFAULT_MAX_INTERVAL):
+        super().__init__(folder, journal)
+        self.interval = interval
+        self.max_interval = max(max_interval, interval)
+        self._lock = threading.Lock()
+        self._previous = {}
+
+    def start(self):
+        if self.running:
+            return
+        # The reference snapshot is taken before start() returns, so nothing that happens afterwards is missed
+        self._previous = self._snapshot()
+        super().start()
+
+    def flush(self):
+        with self._lock:
+            self._poll()
+
+    def _snapshot(self) -> dict:
+        entries = {}
+        stack = [("", self.folder)]
+        while stack:
+            rel_dir, dir_path = stack.pop()
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                        try:
+                            stat_result = entry.stat()
+                        except OSError:
+                            continue
+                        is_dir = stat.S_ISDIR(stat_result.st_mode)
+                        entries[rel_path] = (is_dir, 0 if is_dir else stat_result.st_size, stat_result.st_mtime_ns)
+                        if is_dir and entry.is_dir(follow_symlinks=False):
+                            stack.append((rel_path, entry.path))
+            except OSError:
+                continue
+        return entries
+
+    def _poll(self) -> bool:
+        """Record the changes since the previous pass, return True if there were any."""
+        current = self._snapshot()
+        changed = current != self._previous
+        for rel_path, signature in current.items():
+            old_signature = self._previous.get(rel_path)
+            if old_signature is None:
+                self.journal.record(rel_path, "created")
+            elif old_signature != signature:
+                self.journal.record(rel_path, "modified")
+        for rel_path in self._previous.keys() - current.keys():
+            self.journal.record(rel_path, "deleted")
+        self._previous = current
+        return changed
+
+    def _run(self):
+        wait = self.interval
+        while not self._stop_event.wait(wait):
+            with self._lock:
+                changed = self._poll()
+            wait = self.interval if changed else min(wait * 2, self.max_interval)
+
+
+class InotifyWatcher(FolderWatcher):
+    """Linux watcher built on inotify (through ctypes), with one watch per folder of the tree."""
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_EXCL_UNLINK)
+    EVENT_HEADER = struct.Struct("iIII")
+    _libc = None
+
+    @classmethod
+    def available(cls) -> bool:
+        if not sys.platform.startswith("linux"):
+            return False
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                for name in ("inotify_init1", "inotify_add_watch", "inotify_rm_watch"):
+                    getattr(libc, name)  # Raises AttributeError if the C library has no inotify support
+                cls._libc = libc
+            except (OSError, AttributeError):
+                return False
+        return True
+
+    def __init__(self, folder: str, journal: ChangeJournal):
+        super().__init__(folder, journal)
+        self._fd = None
+        self._wakeup = None
+        self._watches = {}  # wd -> relative folder path
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.running:
+            return
+        if not self.available():
+            raise OSError("inotify is not available on this system")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        self._wakeup = os.pipe()
+        self._watches = {}
+        # Watches are added before the thread starts, so nothing that happens after start() returns is missed
+        self._add_tree("")
+        super().start()
+
+    def stop(self):
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b"x")
+        super().stop()
+        for fd in ([self._fd] if self._fd is not None else []) + list(self._wakeup or []):
+            os.close(fd)
+        self._fd, self._wakeup, self._watches = None, None, {}
+
+    def _add_watch(self, rel_dir: str) -> bool:
+        full_path = os.path.join(self.folder, rel_dir) if rel_dir else self.folder
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(full_path), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                self.journal.record_overflow("inotify watch limit reached (fs.inotify.max_user_watches)")
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                logger.warning(f"Cannot watch folder \"{full_path}\": {os.strerror(err)}")
+                self.journal.record_folder(rel_dir)
+            return False
+        self._watches[wd] = rel_dir
+        return True
+
+    def _add_tree(self, rel_dir: str):
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            if not self._add_watch(current):
+                continue
+            full_path = os.path.join(self.folder, current) if current else self.folder
+            try:
+                with os.scandir(full_path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(os.path.join(current, entry.name) if current else entry.name)
+            except OSError:
+                continue
+
+    def _remove_tree(self, rel_dir: str):
+        prefix = rel_dir + os.sep
+        for wd, watched in list(self._watches.items()):
+            if watched == rel_dir or watched.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def flush(self):
+        if self._fd is None:
+            return
+        with self._lock:
+            self._read_events()
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            self._handle_events(data)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._fd, self._wakeup[0]], [], [])
+            if self._wakeup[0] in readable:
+                return
+            with self._lock:
+                self._read_events()
+
+    def _handle_events(self, data: bytes):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                self.journal.record_overflow("inotify event queue overflowed")
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if not name:
+                # Event on the watched folder itself
+                if (mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF)) and rel_dir == "":
+                    self.journal.record_overflow("watched folder was removed or moved")
+                elif mask & self.IN_ATTRIB:
+                    self.journal.record(rel_dir, "modified")
+                continue
+            rel_path = os.path.join(rel_dir, name) if rel_dir else name
+            is_dir = bool(mask & self.IN_ISDIR)
+            if mask & self.IN_CREATE:
+                self.journal.record(rel_path, "created")
+                if is_dir:
+                    # Files may have been created before the watch was in place, rescan the new folder entirely
+                    self._add_tree(rel_path)
+                    self.journal.record_folder(rel_path)
+            elif mask & self.IN_MOVED_TO:
+                self.journal.record(rel_path, "moved")
+                if is_dir:
+                    self._add_tree(rel_path)
+                    self.journal.record_folder(rel_path)
+            elif mask & self.IN_MOVED_FROM:
+                self.journal.record(rel_path, "moved")
+                if is_dir:
+                    self._remove_tree(rel_path)
+                    self.journal.record_folder(rel_path)
+            elif mask & self.IN_DELETE:
+                self.journal.record(rel_path, "deleted")
+                if is_dir:
+                    self.journal.record_folder(rel_path)
+            elif mask & (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_ATTRIB):
+                self.journal.record(rel_path, "modified")
+
+
+def create_watcher(folder: str, journal: ChangeJournal, mode: str = "auto",
+                   poll_interval: float = PollingWatcher.DEFAULT_INTERVAL,
+                   poll_max_interval: float = PollingWatcher.DEFAULT_MAX_INTERVAL):
+    """
+    Create (but do not start) a watcher for `folder`.
+
+    mode is "inotify", "poll" or "auto" (inotify where available, polling otherwise).
+    """
+    if mode not in ("auto", "inotify", "poll"):
+        raise ValueError(f"Invalid watch mode: {mode}")
+    if mode == "inotify" or (mode == "auto" and InotifyWatcher.available()):
+        return InotifyWatcher(folder, journal)
+    return PollingWatcher(folder, journal, poll_interval, poll_max_interval)
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from file_hash import FileHasher
+
+logger = logging.getLogger("SYNC")
+
+
+class HashCache:
+    """
+    Persistent cache of file hashes for one folder, keyed by relative path.
+
+    Each entry stores the stat signature (size, mtime_ns, inode, ctime_ns) the hash was computed for, the kind of
+    hash (FileHasher.algo) and, for tree hashes, the block digests. A cached hash is only reused while the signature
+    and the kind are unchanged, so rescanning an unchanged tree reads no file content.
+    Entries are kept in least-recently-used order and the oldest ones are dropped once max_entries is exceeded.
+    The cache can be shared by threads, e.g. the workers of execute_sync.
+    """
+    DEFAULT_MAX_ENTRIES = 1_000_000
+    VERSION = 1
+
+    def __init__(self, cache_file: str = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self._cache_file = cache_file
+        self._max_entries = max(int(max_entries), 0) if max_entries is not None else self.DEFAULT_MAX_ENTRIES
+        self._entries = OrderedDict()  # popitem(last=False) drops the oldest entry in O(1)
+        self._modified = False
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, rel_path):
+        return rel_path in self._entries
+
+    @property
+    def cache_file(self):
+        return self._cache_file
+
+    @staticmethod
+    def cache_file_for(cache_dir: str, folder: str) -> str:
+        """Return the cache file used for `folder` inside `cache_dir`."""
+        key = hashlib.sha1(os.path.normcase(os.path.abspath(folder)).encode("utf-8")).hexdigest()
+        return os.path.join(cache_dir, f"{key}.json")
+
+    @staticmethod
+    def signature(stat_result: os.stat_result) -> list:
+        return [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, stat_result.st_ctime_ns]
+
+    def load(self):
+        self._entries = OrderedDict()
+        self._modified = False
+        if not self._cache_file or not os.path.isfile(self._cache_file):
+            return
+        try:
+            with open(self._cache_file, "r") as f:
+                data = json.load(f)
+            if data.get("version") != self.VERSION:
+                logger.debug(f"Discarding hash cache with unknown version: \"{self._cache_file}\"")
+                return
+            self._entries = OrderedDict(data.get("entries", {}))
+            logger.debug(f"Hash cache loaded with {len(self._entries)} entries: \"{self._cache_file}\"")
+        except Exception as e:
+            logger.warning(f"Error loading hash cache \"{self._cache_file}\", starting empty. Error: {str(e)}")
+            self._entries = OrderedDict()
+        self._evict()
+
+    def save(self):
+        if not self._cache_file or not self._modified:
+            return
+        tmp_file = f"{self._cache_file}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self._cache_file)), exist_ok=True)
+            with self._lock:
+                entries = dict(self._entries)
+            with open(tmp_file, "w") as f:
+                json.dump({"version": self.VERSION, "entries": entries}, f, separators=(",", ":"))
+            os.replace(tmp_file, self._cache_file)
+            self._modified = False
+            logger.debug(f"Hash cache saved with {len(self._entries)} entries: \"{self._cache_file}\"")
+        except Exception as e:
+            logger.error(f"Error saving hash cache \"{self._cache_file}\". Error: {str(e)}")
+
+    @staticmethod
+    def _algo(entry: list) -> str:
+        return entry[2] if len(entry) > 2 else FileHasher.DEFAULT_ALGO  # Entries written before hash kinds existed
+
+    def lookup(self, rel_path: str, stat_result: os.stat_result, algo: str = FileHasher.DEFAULT_ALGO):
+        """Return the cached `algo` hash of `rel_path` if it is still valid for `stat_result`, otherwise None."""
+        with self._lock:
+            entry = self._entries.get(rel_path)
+            if (entry is None) or (entry[0] != self.signature(stat_result)) or (self._algo(entry) != algo):
+                return None  # A stale entry is kept until replaced, its blocks may still be reused
+            self._entries.move_to_end(rel_path)  # Most recently used position
+            return entry[1]
+
+    def appended_blocks(self, rel_path: str, stat_result: os.stat_result, algo: str) -> tuple:
+        """
+        Return (block digests, size) of the cached version of a file that may have been appended to since, i.e.
+        the same inode with a size not smaller than the cached one, or (None, 0).
+        """
+        with self._lock:
+            entry = self._entries.get(rel_path)
+        if (entry is None) or (len(entry) < 4) or (self._algo(entry) != algo):
+            return None, 0
+        size, _mtime_ns, inode, _ctime_ns = entry[0]
+        if (inode != stat_result.st_ino) or (stat_result.st_size < size):
+            return None, 0
+        return entry[3], size
+
+    def store(self, rel_path: str, stat_result: os.stat_result, file_hash: str, algo: str = FileHasher.DEFAULT_ALGO,
+              blocks: list = None):
+        if blocks is not None:
+            entry = [self.signature(stat_result), file_hash, algo, blocks]
+        elif algo != FileHasher.DEFAULT_ALGO:
+            entry = [self.signature(stat_result), file_hash, algo]
+        else:
+            entry = [self.signature(stat_result), file_hash]
+        with self._lock:
+            self._entries.pop(rel_path, None)
+            self._entries[rel_path] = entry
+            self._modified = True
+            self._evict()
+
+    def get_hash(self, rel_path: str, full_path: str, hasher: FileHasher = None, stat_result: os.stat_result = None) -> str:
+        """
+        Return the hash of `full_path`, computing it with `hasher` only if the cached entry is missing or stale.
+
+        The file is stat'ed before it is read, so a file modified while being hashed is re-hashed on the next scan.
+        With hasher.detect_appends, a tree hash only reads the blocks added since the cached version (see
+        FileHasher.hash_blocks).
+        """
+        hasher = hasher or FileHasher()
+        if stat_result is None:
+            stat_result = os.stat(full_path)
+        file_hash = self.lookup(rel_path, stat_result, hasher.algo)
+        if file_hash is not None:
+            self.hits += 1
+            return file_hash
+        self.misses += 1
+        if hasher.mode == "tree":
+            known_blocks, known_size = self.appended_blocks(rel_path, stat_result, hasher.algo) \
+                if hasher.detect_appends else (None, 0)
+            file_hash, blocks = hasher.hash_blocks(full_path, known_blocks, known_size)
+            self.store(rel_path, stat_result, file_hash, hasher.algo, blocks)
+        else:
+            file_hash = hasher.hash_file(full_path)
+            self.store(rel_path, stat_result, file_hash, hasher.algo)
+        return file_hash
+
+    def prune(self, existing_paths):
+        """Drop the entries of paths that are not in `existing_paths`."""
+        existing_paths = set(existing_paths)
+        with self._lock:
+            stale = [rel_path for rel_path in self._entries if rel_path not in existing_paths]
+            for rel_path in stale:
+                del self._entries[rel_path]
+            if stale:
+                self._modified = True
+            logger.debug(f"Hash cache pruned {len(stale)} entries")
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._modified = True
+
+    def _evict(self):
+        excess = len(self._entries) - self._max_entries
+        if excess <= 0:
+            return
+        for _ in range(excess):
+            self._entries.popitem(last=False)
+        self._modified = True
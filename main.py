@@ -1,9 +1,17 @@
-from ui import MainApp
+import multiprocessing
+import sys
+
 from dotenv import load_dotenv
 
 load_dotenv()
 
 if __name__ == "__main__":
+    # Frozen builds start the process scan workers (scan_executor "process") by running this executable again
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        # Command line mode (see cli.py), without importing the UI
+        from cli import main
+        sys.exit(main())
+    from ui import MainApp
     root = MainApp()
     root.mainloop()
-
@@ -1,26 +1,85 @@
 import os
 import json
+import logging
+import threading
+from collections import Counter
 from icecream import ic
 from dotenv import load_dotenv
 import uuid
 
+from file_copy import FileCopier
+from file_hash import FileHasher
+from folder_watcher import PollingWatcher
+from hash_cache import HashCache
+from project_store import ProjectIndex, get_store, is_project_file
+from sync_history import SyncHistory
 from sync_manager import SyncManager
 
 load_dotenv()
 DEBUG = os.environ.get("DEBUG", False)
 PROJECTS_DIR = os.environ.get("PROJECTS_DIR")
 # PROJECT_LIST_FILE = os.path.join(PROJECTS_DIR, "project_list.json")
+logger = logging.getLogger("SYNC")
+_index_lock = threading.Lock()  # Projects synced at the same time (see SyncScheduler) share the index file
+CONFLICT_POLICIES = ("both", "a", "b", "newer", "skip", "fail")
+
+
+def get_projects_dir() -> str:
+    if not PROJECTS_DIR:
+        raise ValueError("PROJECTS_DIR is not set, define it in the environment or in a .env file")
+    return PROJECTS_DIR
+
+
+def get_cache_dir():
+    """Return the folder of the hash caches, sync journals and project index, None if PROJECTS_DIR is not set."""
+    return os.path.join(PROJECTS_DIR, "cache") if PROJECTS_DIR else None
+
+
+def get_index_file():
+    cache_dir = get_cache_dir()
+    return os.path.join(cache_dir, "project_index.json") if cache_dir else None
+
 
 class Project:
     def __init__(self, **kwargs):
+        storage = kwargs.get("storage", "json")
         self._config = {
             "project_name": kwargs.get("project_name", ""),
-            "project_path": kwargs.get("project_path", f"{os.path.join(PROJECTS_DIR, uuid.uuid4().hex)}.json"),
+            "project_path": kwargs.get("project_path") or f"{os.path.join(get_projects_dir(), uuid.uuid4().hex)}{get_store(storage=storage).EXTENSION}",
+            "storage": storage,
             "folder_a": kwargs.get("folder_a", ""),
             "folder_b": kwargs.get("folder_b", ""),
             "history": kwargs.get("history", {}),
+            "hash_cache_size": kwargs.get("hash_cache_size", HashCache.DEFAULT_MAX_ENTRIES),
+            "scan_workers": kwargs.get("scan_workers", 4),
+            "scan_executor": kwargs.get("scan_executor", "thread"),
+            "scan_chunk_size": kwargs.get("scan_chunk_size", 16),
+            "compare_mode": kwargs.get("compare_mode", "hash"),
+            "hash_mode": kwargs.get("hash_mode", "flat"),
+            "hash_function": kwargs.get("hash_function", "sha256"),
+            "hash_sample_size": kwargs.get("hash_sample_size", FileHasher.DEFAULT_SAMPLE_SIZE),
+            "hash_buffer_size": kwargs.get("hash_buffer_size", FileHasher.DEFAULT_BUFFER_SIZE),
+            "hash_block_size": kwargs.get("hash_block_size", FileHasher.DEFAULT_BLOCK_SIZE),
+            "hash_detect_appends": kwargs.get("hash_detect_appends", False),
+            "hash_mmap_threshold": kwargs.get("hash_mmap_threshold", None),
+            "sync_workers": kwargs.get("sync_workers", 4),
+            "copy_backend": kwargs.get("copy_backend", "auto"),
+            "copy_buffer_size": kwargs.get("copy_buffer_size", FileCopier.DEFAULT_BUFFER_SIZE),
+            "delta_threshold": kwargs.get("delta_threshold", None),
+            "delta_block_size": kwargs.get("delta_block_size", FileCopier.DEFAULT_DELTA_BLOCK_SIZE),
+            "watch_mode": kwargs.get("watch_mode", "off"),
+            "watch_poll_interval": kwargs.get("watch_poll_interval", PollingWatcher.DEFAULT_INTERVAL),
+            "watch_poll_max_interval": kwargs.get("watch_poll_max_interval", PollingWatcher.DEFAULT_MAX_INTERVAL),
+            "history_rebase_interval": kwargs.get("history_rebase_interval", SyncHistory.DEFAULT_REBASE_INTERVAL),
+            "history_keep_last": kwargs.get("history_keep_last", None),
+            "history_keep_days": kwargs.get("history_keep_days", None),
+            "history_thin_daily": kwargs.get("history_thin_daily", True),
+            "conflict_policy": kwargs.get("conflict_policy", "both"),
+            "schedule_priority": kwargs.get("schedule_priority", 0),
+            "schedule_interval": kwargs.get("schedule_interval", None),
         }
-        self._sync_manager = SyncManager(**self._config)
+        self._sync_manager = SyncManager(**self._config, cache_dir=get_cache_dir())
+        self._loaded = kwargs.get("loaded", True)
         self._modified = False
 
     def __str__(self):
@@ -34,18 +93,57 @@ class Project:
             return False
         return self._config["project_name"] == other._config["project_name"]
 
-    def load_from_file(self):
-        self._config.update(json.load(open(self._config["project_path"], "r")))
-        self._sync_manager = SyncManager(**self._config)
-        self._modified = False
+    def load_from_file(self, overrides: dict = None):
+        """Load the project file, then apply the config values in `overrides` over the ones it holds."""
+        self._config.update(get_store(self._config["project_path"]).load(self._config["project_path"]))
+        self._config.update(overrides or {})
+        watching = self._sync_manager.is_watching("a") or self._sync_manager.is_watching("b")
+        self._sync_manager.stop_watching()
+        self._sync_manager = SyncManager(**self._config, cache_dir=get_cache_dir())
+        if watching:
+            self._sync_manager.start_watching()
+        self._loaded = True
+        self._modified = bool(overrides)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def ensure_loaded(self):
+        """Load the full project state (history included) if the project was created from its header only."""
+        if not self._loaded:
+            # Header fields changed before the full load (e.g. a rename) must not be reverted by the file
+            self.load_from_file({k: v for k, v in self._config.items() if k != "history"} if self._modified else None)
 
     def save_to_file(self):
-        self._config["history"] = self._sync_manager.history
-        with open(self._config["project_path"], "w") as f:
-            json.dump(self._config, f, indent=4)
-            f.close()
+        self.ensure_loaded()
+        self._sync_manager.compact_history()
+        self._config["history"] = self._sync_manager.history.to_dict()
+        get_store(storage=self._config["storage"]).save(self._config["project_path"], self._config)
+        if get_index_file() is not None:
+            with _index_lock:
+                index = ProjectIndex(get_index_file())
+                index.update(self._config["project_path"], self._config)
+                index.save()
         self._modified = False
 
+    def migrate_storage(self, storage: str):
+        """
+        Convert the project file to another storage backend ("json" or "sqlite").
+
+        The project is saved under the same name with the extension of the new backend, then the old file is removed.
+        """
+        store = get_store(storage=storage)
+        if storage == self._config["storage"]:
+            return
+        self.ensure_loaded()
+        old_path = self._config["project_path"]
+        self._config["storage"] = storage
+        self._config["project_path"] = f"{os.path.splitext(old_path)[0]}{store.EXTENSION}"
+        self.save_to_file()
+        if os.path.exists(old_path) and (os.path.abspath(old_path) != os.path.abspath(self._config["project_path"])):
+            os.remove(old_path)
+
     # @property
     # def sync_manager(self):
     #     return self._sync_manager
@@ -61,6 +159,10 @@ class Project:
         self._config["project_name"] = str(value)
         self._modified = True
 
+    @property
+    def project_path(self):
+        return self._config.get("project_path", "")
+
     @property
     def folder_a(self):
         return self._config.get("folder_a", "")
@@ -69,9 +171,28 @@ class Project:
     def folder_b(self):
         return self._config.get("folder_b", "")
 
+    @property
+    def conflict_policy(self):
+        return self._config.get("conflict_policy", "both")
+
+    @property
+    def schedule_priority(self):
+        return self._config.get("schedule_priority", 0)
+
+    @property
+    def schedule_interval(self):
+        return self._config.get("schedule_interval", None)
+
+    def get_devices(self) -> set:
+        """Return the devices (st_dev) holding the project's folders."""
+        return {os.stat(folder).st_dev for folder in (self.folder_a, self.folder_b)}
+
     @property
     def history(self):
-        return self._config.get("history", {})
+        return self._sync_manager.history
+
+    def get_history_snapshot(self, key: str) -> dict:
+        return self._sync_manager.get_history_snapshot(key)
 
     # @history.setter
     # def history(self, value):
@@ -86,12 +207,38 @@ class Project:
         return self._modified
 
     def get_config(self):
+        self.ensure_loaded()
+        self._config["history"] = self._sync_manager.history.to_dict()
         return self._config.copy()
 
-    def get_folder_state(self, which: str):
-        return self._sync_manager.get_folder_state(which)
+    def start_watching(self):
+        self.ensure_loaded()
+        self._sync_manager.start_watching()
+
+    def stop_watching(self):
+        self._sync_manager.stop_watching()
+
+    def cancel(self):
+        """Stop the running prep_sync, execute_sync or resume_sync, which raises SyncCancelled. Thread safe."""
+        self._sync_manager.cancel()
+
+    def clear_cancel(self):
+        self._sync_manager.clear_cancel()
+
+    def add_progress_listener(self, callback):
+        self._sync_manager.add_progress_listener(callback)
+
+    def remove_progress_listener(self, callback):
+        self._sync_manager.remove_progress_listener(callback)
+
+    def get_last_run_summary(self):
+        return self._sync_manager.last_run_summary
+
+    def get_folder_state(self, which: str, rescan: bool = False):
+        return self._sync_manager.get_folder_state(which, rescan)
 
     def prep_sync(self):
+        self.ensure_loaded()
         self._sync_manager.prep_sync()
 
     def get_sync_actions(self):
@@ -111,18 +258,60 @@ class Project:
     def modify_action(self, rel_path: str, new_action: str):
         self._sync_manager.modify_action(rel_path, new_action)
 
+    def skip_action(self, rel_path: str):
+        self._sync_manager.skip_action(rel_path)
+
     def get_future_common_state(self):
         return self._sync_manager.future_common_state
 
+    def resolve_conflicts(self, policy: str) -> int:
+        """
+        Apply a conflict policy (see CONFLICT_POLICIES) to the prepared sync actions, return the number of conflicts.
+        "both", "a" and "b" keep both versions or the one of folder A / B, "newer" the one modified last, "skip"
+        leaves the conflicting files out of the sync and "fail" leaves the conflicts unresolved.
+        """
+        conflicts = self.get_conflicts()
+        future_state = self.get_future_common_state()
+        for rel_path in conflicts:
+            if policy == "skip":
+                self.skip_action(rel_path)
+            elif policy == "a":
+                self.modify_action(rel_path, "conflict keep A")
+            elif policy == "b":
+                self.modify_action(rel_path, "conflict keep B")
+            elif policy == "newer":
+                props = future_state.get(rel_path, {})
+                newer = "A" if props.get("mtime_a", 0) >= props.get("mtime_b", 0) else "B"
+                self.modify_action(rel_path, f"conflict keep {newer}")
+            elif policy == "both":
+                self.modify_action(rel_path, "conflict keep both")
+        return len(conflicts)
+
+    def count_actions(self) -> dict:
+        """Count the prepared sync actions by kind, "no action" entries excluded."""
+        return dict(Counter(action for action in (self.get_sync_actions() or {}).values() if action != "no action"))
+
     def execute_sync(self):
         self._sync_manager.execute_sync()
-        self._config["history"] = self._sync_manager.history
         self.save_to_file()
+        self._sync_manager.discard_sync_journal()
+        self._modified = False
+
+    def get_interrupted_sync(self):
+        self.ensure_loaded()
+        return self._sync_manager.get_interrupted_sync()
+
+    def resume_sync(self):
+        self.ensure_loaded()
+        self._sync_manager.resume_sync()
+        self.save_to_file()
+        self._sync_manager.discard_sync_journal()
         self._modified = False
 
 class ProjectManager:
     def __init__(self):
         self.projects = []
+        self._projects_by_name = {}
         self._active_project = None
 
     @property
@@ -155,27 +344,58 @@ class ProjectManager:
         - Sets self._active_project to None, a Project instance, or raises an error.
         """
         if not value:
-            self._active_project = None
+            self._set_active(None)
             return
         if isinstance(value, Project):
-            self._active_project = value
+            self._set_active(value)
             return
         project = self.get_project_by_name(str(value))
         if project:
-            self._active_project = project
+            self._set_active(project)
         else:
             raise ValueError(f"Invalid project: {value}")
 
+    def _set_active(self, project):
+        # Only the active project keeps its folder watchers running
+        if self._active_project is project:
+            return
+        if self._active_project:
+            self._active_project.stop_watching()
+        self._active_project = project
+        if project:
+            # Projects are listed from their headers, the full state is only loaded when activated
+            project.ensure_loaded()
+            project.start_watching()
+
     def load_projects(self):
-        if not os.path.exists(PROJECTS_DIR):
-            os.makedirs(PROJECTS_DIR)
+        """
+        List the projects in PROJECTS_DIR.
+
+        Only the project headers (configuration without history) are read, through the project index, so the cost
+        does not depend on the size of the histories. The full state is loaded when a project is activated.
+        """
+        projects_dir = get_projects_dir()
+        if not os.path.exists(projects_dir):
+            os.makedirs(projects_dir)
         self.projects.clear()
-        for project_path in [os.path.join(PROJECTS_DIR, fname) for fname in os.listdir(PROJECTS_DIR)]:
-            if os.path.splitext(project_path)[1] != ".json":
+        index = ProjectIndex(get_index_file())
+        project_paths = [os.path.join(projects_dir, fname) for fname in os.listdir(projects_dir)]
+        project_paths = [path for path in project_paths if os.path.isfile(path) and is_project_file(path)]
+        for project_path in project_paths:
+            try:
+                project_config = index.get_header(project_path)
+            except Exception as e:
+                logger.error(f"Error reading project file \"{project_path}\": {str(e)}")
                 continue
-            project_config = json.load(open(project_path, "r"))
             project_config["project_path"] = os.path.abspath(project_path)
-            self.projects.append(Project(**project_config))
+            project_config["storage"] = get_store(project_path).STORAGE
+            self.projects.append(Project(**project_config, loaded=False))
+        index.prune(project_paths)
+        index.save()
+        self._rebuild_name_index()
+
+    def _rebuild_name_index(self):
+        self._projects_by_name = {project.project_name: project for project in self.projects}
 
     def create_project(self, **kwargs):
         """
@@ -200,7 +420,8 @@ class ProjectManager:
         """
         project = Project(**kwargs)
         self.projects.append(project)
-        self._active_project = project
+        self._projects_by_name[project.project_name] = project
+        self._set_active(project)
 
     def load_project_from_file(self, project_name):
         project = self.get_project_by_name(project_name)
@@ -218,7 +439,8 @@ class ProjectManager:
         del new_config["project_path"]
         new_project = Project(**new_config)
         self.projects.append(new_project)
-        self._active_project = new_project
+        self._projects_by_name[new_project.project_name] = new_project
+        self._set_active(new_project)
         self._active_project.save_to_file()
 
     def delete_project(self, project):
@@ -226,9 +448,10 @@ class ProjectManager:
         if not target:
             return
         if self._active_project == target:
-            self._active_project = None
-        os.remove(target.get_config()["project_path"])
+            self._set_active(None)
+        os.remove(target.project_path)
         self.projects.remove(target)
+        self._rebuild_name_index()
 
     def set_active_project(self, project_name):
         """
@@ -248,14 +471,14 @@ class ProjectManager:
         """
         project = self.get_project_by_name(project_name)
         if project:
-            self._active_project = project
+            self._set_active(project)
 
     def get_project_by_name(self, project_name):
         """
         Retrieve a project from the project list by its name.
 
-        This function searches through the list of projects and returns the project
-        that matches the given project name.
+        This function looks the name up in the name index, which is rebuilt
+        once if the lookup misses (e.g. after a project was renamed).
 
         Args:
             project_name (str): The name of the project to search for.
@@ -263,10 +486,11 @@ class ProjectManager:
         Returns:
             Project or None: The Project object if a match is found, None otherwise.
         """
-        for project in self.projects:
-            if project.project_name == project_name:
-                return project
-        return None
+        project = self._projects_by_name.get(project_name)
+        if (project is None) or (project.project_name != project_name):
+            self._rebuild_name_index()
+            project = self._projects_by_name.get(project_name)
+        return project
     
     def get_project_names(self):
         """
@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+
+logger = logging.getLogger("SYNC")
+
+_HEX_RE = re.compile(r"(?:[0-9a-f]{2})+")
+
+
+class JsonProjectStore:
+    """Project file as a single indented JSON document (the original format)."""
+    STORAGE = "json"
+    EXTENSION = ".json"
+
+    @staticmethod
+    def load(path: str) -> dict:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def load_header(path: str) -> dict:
+        # JSON has to be parsed in full, ProjectIndex caches the result
+        config = JsonProjectStore.load(path)
+        config.pop("history", None)
+        return config
+
+    @staticmethod
+    def save(path: str, config: dict):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(config, f, indent=4)
+        os.replace(tmp_path, path)
+
+
+class SqliteProjectStore:
+    """
+    Project file as an SQLite database with the history stored in columns.
+
+    Every relative path is stored once in the `paths` table and referenced by id. History entries are rows of
+    (sync, path, op, type, size, mtime, ctime, hash), with hex hashes packed as blobs and folder hashes (equal to
+    the path) left NULL. Props that do not fit the columns are kept as JSON in `extra`.
+    """
+    STORAGE = "sqlite"
+    EXTENSION = ".ftdb"
+    SCHEMA_VERSION = 1
+    OP_SET, OP_DEL = 0, 1
+    TYPES = {"file": 0, "folder": 1}
+    TYPE_NAMES = {code: name for name, code in TYPES.items()}
+    COLUMNS = ("type", "size", "mtime", "ctime", "hash")
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        return sqlite3.connect(path)
+
+    @staticmethod
+    def load_config(conn: sqlite3.Connection) -> dict:
+        return {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM config")}
+
+    @classmethod
+    def load_header(cls, path: str) -> dict:
+        conn = cls._connect(path)
+        try:
+            return cls.load_config(conn)
+        finally:
+            conn.close()
+
+    @classmethod
+    def load(cls, path: str) -> dict:
+        conn = cls._connect(path)
+        try:
+            config = cls.load_config(conn)
+            paths = dict(conn.execute("SELECT id, path FROM paths"))
+            entries = {}
+            syncs = {}
+            for sync_id, key, kind in conn.execute("SELECT id, key, kind FROM syncs ORDER BY key"):
+                syncs[sync_id] = {} if kind == "base" else {"set": {}, "del": []}
+                entries[key] = {kind: syncs[sync_id]}
+            rows = conn.execute("SELECT sync_id, path_id, op, type, size, mtime, ctime, hash, extra FROM entries "
+                                "ORDER BY sync_id, rowid")
+            for sync_id, path_id, op, type_code, size, mtime, ctime, file_hash, extra in rows:
+                rel_path = paths[path_id]
+                target = syncs[sync_id]
+                if op == cls.OP_DEL:
+                    target["del"].append(rel_path)
+                    continue
+                props = {"type": cls.TYPE_NAMES.get(type_code, type_code), "ctime": ctime, "mtime": mtime,
+                         "hash": rel_path if file_hash is None else (file_hash.hex() if isinstance(file_hash, bytes) else file_hash),
+                         "size": size}
+                if extra:
+                    props.update(json.loads(extra))
+                if "set" in target:
+                    target["set"][rel_path] = props
+                else:
+                    target[rel_path] = props
+            config["history"] = {"format": "delta", "version": 1, "entries": entries}
+            return config
+        finally:
+            conn.close()
+
+    @classmethod
+    def _encode_props(cls, rel_path: str, props: dict) -> tuple:
+        extra = {k: v for k, v in props.items() if k not in cls.COLUMNS}
+        file_hash = props.get("hash")
+        if file_hash == rel_path:
+            file_hash = None
+        elif isinstance(file_hash, str) and _HEX_RE.fullmatch(file_hash):
+            file_hash = bytes.fromhex(file_hash)
+        elif not isinstance(file_hash, str):
+            extra["hash"] = file_hash
+            file_hash = None
+        type_code = cls.TYPES.get(props.get("type"), props.get("type"))
+        return (type_code, props.get("size"), props.get("mtime"), props.get("ctime"), file_hash,
+                json.dumps(extra) if extra else None)
+
+    @classmethod
+    def save(cls, path: str, config: dict):
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = cls._connect(tmp_path)
+        try:
+            conn.execute("PRAGMA journal_mode=OFF")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.executescript("""
+                CREATE TABLE config (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE paths (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL);
+                CREATE TABLE syncs (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, kind TEXT NOT NULL);
+                CREATE TABLE entries (sync_id INTEGER NOT NULL, path_id INTEGER NOT NULL, op INTEGER NOT NULL,
+                                      type INTEGER, size INTEGER, mtime REAL, ctime REAL, hash BLOB, extra TEXT);
+            """)
+            conn.execute(f"PRAGMA user_version={cls.SCHEMA_VERSION}")
+            history = config.get("history") or {}
+            conn.executemany("INSERT INTO config (key, value) VALUES (?, ?)",
+                             [(key, json.dumps(value)) for key, value in config.items() if key != "history"])
+            path_ids = {}
+
+            def path_id(rel_path):
+                if rel_path not in path_ids:
+                    path_ids[rel_path] = len(path_ids) + 1
+                return path_ids[rel_path]
+
+            rows = []
+            for sync_id, (key, entry) in enumerate(history.get("entries", {}).items(), start=1):
+                kind = "base" if "base" in entry else "delta"
+                conn.execute("INSERT INTO syncs (id, key, kind) VALUES (?, ?, ?)", (sync_id, key, kind))
+                if kind == "base":
+                    items, deleted = entry["base"].items(), []
+                else:
+                    items, deleted = entry["delta"].get("set", {}).items(), entry["delta"].get("del", [])
+                for rel_path, props in items:
+                    rows.append((sync_id, path_id(rel_path), cls.OP_SET) + cls._encode_props(rel_path, props))
+                for rel_path in deleted:
+                    rows.append((sync_id, path_id(rel_path), cls.OP_DEL, None, None, None, None, None, None))
+            conn.executemany("INSERT INTO paths (id, path) VALUES (?, ?)",
+                             [(rel_id, rel_path) for rel_path, rel_id in path_ids.items()])
+            conn.executemany("INSERT INTO entries (sync_id, path_id, op, type, size, mtime, ctime, hash, extra) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.commit()
+        finally:
+            conn.close()
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+STORES = {store.STORAGE: store for store in (JsonProjectStore, SqliteProjectStore)}
+
+
+def get_store(path: str = None, storage: str = None):
+    """Return the store class for `storage` ("json" or "sqlite"), or the one matching the extension of `path`."""
+    if storage is not None:
+        if storage not in STORES:
+            raise ValueError(f"Invalid project storage: {storage}")
+        return STORES[storage]
+    extension = os.path.splitext(path or "")[1].lower()
+    for store in STORES.values():
+        if store.EXTENSION == extension:
+            return store
+    raise ValueError(f"Unknown project file type: \"{path}\"")
+
+
+def is_project_file(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in {store.EXTENSION for store in STORES.values()}
+
+
+class ProjectIndex:
+    """
+    Cache of the project file headers (the configuration without the history), keyed by absolute file path.
+
+    A cached header is valid while the file's size and mtime are unchanged, so listing the projects does not parse
+    any history.
+    """
+    VERSION = 1
+
+    def __init__(self, index_file: str):
+        self._index_file = index_file
+        self._entries = {}
+        self._modified = False
+        if index_file and os.path.isfile(index_file):
+            try:
+                with open(index_file, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == self.VERSION:
+                    self._entries = data.get("entries", {})
+            except Exception as e:
+                logger.warning(f"Error loading project index \"{index_file}\", rebuilding it. Error: {str(e)}")
+
+    @staticmethod
+    def _signature(path: str) -> list:
+        stat_result = os.stat(path)
+        return [stat_result.st_size, stat_result.st_mtime_ns]
+
+    def get_header(self, path: str) -> dict:
+        path = os.path.abspath(path)
+        signature = self._signature(path)
+        entry = self._entries.get(path)
+        if entry and entry["signature"] == signature:
+            return dict(entry["header"])
+        header = get_store(path).load_header(path)
+        self._entries[path] = {"signature": signature, "header": header}
+        self._modified = True
+        return dict(header)
+
+    def update(self, path: str, config: dict):
+        path = os.path.abspath(path)
+        self._entries[path] = {"signature": self._signature(path),
+                               "header": {k: v for k, v in config.items() if k != "history"}}
+        self._modified = True
+
+    def prune(self, existing_paths):
+        existing_paths = {os.path.abspath(path) for path in existing_paths}
+        for path in [path for path in self._entries if path not in existing_paths]:
+            del self._entries[path]
+            self._modified = True
+
+    def save(self):
+        if not self._index_file or not self._modified:
+            return
+        tmp_file = f"{self._index_file}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self._index_file)), exist_ok=True)
+            with open(tmp_file, "w") as f:
+                json.dump({"version": self.VERSION, "entries": self._entries}, f)
+            os.replace(tmp_file, self._index_file)
+            self._modified = False
+        except Exception as e:
+            logger.error(f"Error saving project index \"{self._index_file}\". Error: {str(e)}")
@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sync_manager import SyncCancelled
+
+logger = logging.getLogger("SYNC")
+
+
+class SyncScheduler:
+    """
+    Runs the syncs (prep_sync, conflict resolution, execute_sync) of many projects at the same time.
+
+    Each project has a priority (higher first) and an interval in seconds between the end of a sync and the start of
+    the next one (None to sync once), by default the project's schedule_priority and schedule_interval settings. At
+    most `max_workers` projects sync at once, and at most `device_limit` of them use the same device (st_dev of
+    folder A or B), so projects sharing a disk or a network share do not compete for it. `device_limits` overrides
+    the limit of single devices. A project waiting for a busy device lets lower priority projects on other devices
+    run first.
+    """
+    DEFAULT_WORKERS = 4
+    DEFAULT_DEVICE_LIMIT = 1
+
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, device_limit: int = DEFAULT_DEVICE_LIMIT,
+                 device_limits: dict = None, conflict_policy: str = None):
+        self._max_workers = max(int(max_workers or 1), 1)
+        self._device_limit = max(int(device_limit or 1), 1)
+        self._device_limits = dict(device_limits or {})
+        self._conflict_policy = conflict_policy
+        self._jobs = []
+        self._device_usage = {}
+        self._running = {}
+        self._runs = []
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def add(self, project, priority: int = None, interval: float = None, conflict_policy: str = None):
+        """Schedule `project`, due now. Settings left to None come from the project."""
+        job = {
+            "project": project,
+            "priority": project.schedule_priority if priority is None else priority,
+            "interval": project.schedule_interval if interval is None else interval,
+            "conflict_policy": conflict_policy or self._conflict_policy or project.conflict_policy,
+            "next_run": time.monotonic(),
+            "devices": None,
+        }
+        with self._condition:
+            self._jobs.append(job)
+            self._condition.notify_all()
+
+    def stop(self):
+        """Stop starting syncs and cancel the running ones. Thread safe."""
+        self._stop_event.set()
+        with self._condition:
+            for job in self._running.values():
+                job["project"].cancel()
+            self._condition.notify_all()
+
+    def run(self, once: bool = False) -> list:
+        """
+        Run the scheduled syncs until stop() is called or, with `once` (or when no project has an interval), until
+        every project has synced once. Returns the runs (see report()).
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="scheduler") as pool:
+            with self._condition:
+                while not self._stop_event.is_set():
+                    now = time.monotonic()
+                    for job in self._startable(now, once):
+                        self._acquire(job)
+                        pool.submit(self._run_job, job, once)
+                    # Checked after _startable(), which ends the jobs whose folders cannot be found with `once`
+                    if not self._running and all(job["next_run"] is None for job in self._jobs):
+                        break
+                    # Due jobs waiting for a worker or a device are woken up when a sync ends
+                    later = [job["next_run"] for job in self._jobs
+                             if (job["next_run"] is not None) and (job["next_run"] > now)]
+                    self._condition.wait(min(later) - now if later else None)
+        return self.report()
+
+    def _startable(self, now: float, once: bool) -> list:
+        due = [job for job in self._jobs
+               if (job["next_run"] is not None) and (job["next_run"] <= now) and (id(job) not in self._running)]
+        due.sort(key=lambda job: (-job["priority"], job["next_run"]))
+        startable = []
+        for job in due:
+            if len(self._running) + len(startable) >= self._max_workers:
+                break
+            if job["devices"] is None:
+                try:
+                    job["devices"] = job["project"].get_devices()
+                except OSError as e:
+                    self._record(job, datetime.now(), 0.0, {"status": "failed", "error": str(e)})
+                    self._reschedule(job, now, once)
+                    continue
+            if all(self._device_usage.get(device, 0) < self._limit(device) for device in job["devices"]):
+                startable.append(job)
+                for device in job["devices"]:
+                    self._device_usage[device] = self._device_usage.get(device, 0) + 1
+        # The device slots were taken to check the next jobs against them, _acquire() marks the jobs as running
+        for job in startable:
+            for device in job["devices"]:
+                self._device_usage[device] -= 1
+        return startable
+
+    def _limit(self, device) -> int:
+        return max(int(self._device_limits.get(device, self._device_limit)), 1)
+
+    def _acquire(self, job: dict):
+        self._running[id(job)] = job
+        for device in job["devices"]:
+            self._device_usage[device] = self._device_usage.get(device, 0) + 1
+
+    def _release(self, job: dict):
+        self._running.pop(id(job), None)
+        for device in job["devices"]:
+            self._device_usage[device] -= 1
+
+    def _reschedule(self, job: dict, now: float, once: bool):
+        job["next_run"] = None if once or (job["interval"] is None) else now + float(job["interval"])
+
+    def _run_job(self, job: dict, once: bool):
+        project = job["project"]
+        started = datetime.now()
+        start = time.monotonic()
+        result = {"status": "ok"}
+        try:
+            result.update(self.sync_project(project, job["conflict_policy"]))
+        except SyncCancelled:
+            result = {"status": "cancelled"}
+        except Exception as e:
+            logger.error(f"Scheduled sync of project \"{project.project_name}\" failed. Error: {str(e)}")
+            result = {"status": "failed", "error": str(e)}
+        finally:
+            end = time.monotonic()
+            with self._condition:
+                self._release(job)
+                project.clear_cancel()  # stop() cannot target the job anymore, forget a cancellation that came late
+                self._record(job, started, end - start, result)
+                self._reschedule(job, end, once)
+                job["devices"] = None  # Stat the folders again next time, a share may have been remounted
+                self._condition.notify_all()
+
+    def sync_project(self, project, conflict_policy: str) -> dict:
+        """
+        Sync one project, return its actions, conflicts and bytes copied (status "conflicts" if not synced). Raises
+        SyncCancelled if stop() is called, also between the steps.
+        """
+        result = {"bytes": 0}
+        if project.get_interrupted_sync():
+            self._check_stopped(project)
+            logger.info(f"Resuming the interrupted sync of project \"{project.project_name}\"")
+            project.resume_sync()
+            result["bytes"] += SyncScheduler._bytes_copied(project.get_last_run_summary())
+        self._check_stopped(project)
+        project.prep_sync()
+        result["conflicts"] = len(project.get_conflicts())
+        if result["conflicts"] and (conflict_policy == "fail"):
+            result["status"] = "conflicts"
+            return result
+        project.resolve_conflicts(conflict_policy)
+        result["actions"] = project.count_actions()
+        if result["actions"]:
+            self._check_stopped(project)
+            project.execute_sync()
+            result["bytes"] += SyncScheduler._bytes_copied(project.get_last_run_summary())
+        return result
+
+    def _check_stopped(self, project):
+        if self._stop_event.is_set():
+            raise SyncCancelled(f"Sync of project \"{project.project_name}\" cancelled")
+
+    @staticmethod
+    def _bytes_copied(summary: dict) -> int:
+        if not summary:
+            return 0
+        return sum(phase["bytes"] for phase in summary.get("phases", []) if phase["phase"].startswith("sync"))
+
+    def _record(self, job: dict, started: datetime, seconds: float, result: dict):
+        run = {"project": job["project"].project_name, "started": started.isoformat(timespec="seconds"),
+               "seconds": round(seconds, 3), "status": "ok", "bytes": 0} | result
+        self._runs.append(run)
+        logger.info(f"Scheduled sync of project \"{run['project']}\": {run['status']} in {run['seconds']} s, "
+                    f"{run['bytes']} bytes copied")
+
+    def report(self) -> list:
+        """Return the runs as dicts with the project, start time, seconds, status, actions, conflicts and bytes."""
+        with self._condition:
+            return list(self._runs)
+
+    def summary(self) -> dict:
+        """Return the runs totalled per project: runs, failures, seconds, bytes and the last status."""
+        totals = {}
+        for run in self.report():
+            total = totals.setdefault(run["project"], {"runs": 0, "failed": 0, "seconds": 0.0, "bytes": 0,
+                                                        "status": None})
+            total["runs"] += 1
+            total["failed"] += run["status"] not in ("ok", "conflicts")
+            total["seconds"] = round(total["seconds"] + run["seconds"], 3)
+            total["bytes"] += run["bytes"]
+            total["status"] = run["status"]
+        return totals
@@ -0,0 +1,202 @@
+import json
+import logging
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("SYNC")
+
+
+class SyncHistory(Mapping):
+    """
+    Sync history stored as base snapshots plus per-sync deltas.
+
+    Behaves as a read-only mapping of sync timestamp -> common state snapshot ({rel_path: props}), in timestamp
+    order. Each entry holds either a full snapshot ("base") or the changes from the previous snapshot ("delta", with
+    the set/updated entries and the deleted paths). A new base is stored every `rebase_interval` syncs so rebuilding
+    an old snapshot never has to replay a long chain. The latest snapshot is kept materialized, as prep_sync needs
+    it on every run.
+    """
+    KEY_FORMAT = "%Y-%m-%d %H:%M:%S"
+    FORMAT = "delta"
+    VERSION = 1
+    DEFAULT_REBASE_INTERVAL = 20
+
+    def __init__(self, rebase_interval: int = DEFAULT_REBASE_INTERVAL):
+        self.rebase_interval = max(int(rebase_interval), 1)
+        self._entries = {}  # key -> {"base": snapshot} or {"delta": {"set": {...}, "del": [...]}}, in key order
+        self._latest = None
+        self._deltas_since_base = 0
+
+    @classmethod
+    def from_value(cls, value, rebase_interval: int = DEFAULT_REBASE_INTERVAL):
+        """
+        Build a history from another SyncHistory, its to_dict() form, or the legacy {timestamp: snapshot} dict.
+        """
+        if isinstance(value, SyncHistory):
+            history = cls(rebase_interval)
+            history._load_entries(value.to_dict()["entries"])
+            return history
+        history = cls(rebase_interval)
+        value = value or {}
+        if value.get("format") == cls.FORMAT:
+            if value.get("version") != cls.VERSION:
+                raise ValueError(f"Unsupported history version: {value.get('version')}")
+            history._load_entries(value.get("entries", {}))
+        else:
+            # Legacy format, one full snapshot per sync
+            for key in sorted(value.keys()):
+                history.add(key, value[key])
+            if value:
+                logger.debug(f"Converted {len(value)} legacy history snapshots to base + delta storage")
+        return history
+
+    def to_dict(self) -> dict:
+        return {"format": self.FORMAT, "version": self.VERSION, "entries": self._entries}
+
+    def _load_entries(self, entries: dict):
+        self._entries = {}
+        self._latest = None
+        self._deltas_since_base = 0
+        for key in sorted(entries.keys()):
+            entry = entries[key]
+            if "base" in entry:
+                self._latest = dict(entry["base"])
+                self._deltas_since_base = 0
+            elif self._latest is None:
+                raise ValueError(f"History entry \"{key}\" is a delta without a base snapshot")
+            else:
+                self._apply_delta(self._latest, entry["delta"])
+                self._deltas_since_base += 1
+            self._entries[key] = entry
+
+    def __getitem__(self, key) -> dict:
+        return self.snapshot(key)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def latest_key(self):
+        return next(reversed(self._entries)) if self._entries else None
+
+    def latest(self):
+        """Return the most recent snapshot (not a copy, do not modify it), or None if the history is empty."""
+        return self._latest
+
+    def snapshot(self, key) -> dict:
+        """Rebuild the snapshot stored under `key`."""
+        if key not in self._entries:
+            raise KeyError(key)
+        if key == self.latest_key():
+            return dict(self._latest)
+        keys = list(self._entries)
+        index = keys.index(key)
+        start = index
+        while "base" not in self._entries[keys[start]]:
+            start -= 1
+        snapshot = dict(self._entries[keys[start]]["base"])
+        for k in keys[start + 1:index + 1]:
+            self._apply_delta(snapshot, self._entries[k]["delta"])
+        return snapshot
+
+    def iter_snapshots(self):
+        """Yield (key, snapshot) for every entry in order, replaying the deltas only once."""
+        current = {}
+        for key, entry in self._entries.items():
+            if "base" in entry:
+                current = dict(entry["base"])
+            else:
+                self._apply_delta(current, entry["delta"])
+            yield key, dict(current)
+
+    def add(self, key, snapshot: dict):
+        """Store `snapshot` as the state of the sync identified by `key` (a sortable timestamp string)."""
+        snapshot = dict(snapshot)
+        latest_key = self.latest_key()
+        if (latest_key is not None) and (key <= latest_key):
+            # Same second as the latest sync or a clock change, re-encode the whole history in key order
+            self._rebuild(self._insert_snapshot(key, snapshot))
+            return
+        if (self._latest is None) or (self._deltas_since_base + 1 >= self.rebase_interval):
+            self._entries[key] = {"base": snapshot}
+            self._deltas_since_base = 0
+        else:
+            self._entries[key] = {"delta": self._make_delta(self._latest, snapshot)}
+            self._deltas_since_base += 1
+        self._latest = snapshot
+
+    def _insert_snapshot(self, key, snapshot: dict):
+        """Yield the snapshots in key order with `snapshot` stored under `key`, replacing an entry with that key."""
+        pending = True
+        for k, current in self.iter_snapshots():
+            if pending and (key <= k):
+                yield key, snapshot
+                pending = False
+            if k != key:
+                yield k, current
+        if pending:
+            yield key, snapshot
+
+    def _rebuild(self, snapshots):
+        """Re-encode the history from (key, snapshot) pairs in key order, holding one full snapshot at a time."""
+        history = SyncHistory(self.rebase_interval)
+        for key, snapshot in snapshots:
+            history.add(key, snapshot)
+        self._entries, self._latest, self._deltas_since_base = \
+            history._entries, history._latest, history._deltas_since_base
+
+    @staticmethod
+    def _make_delta(old: dict, new: dict) -> dict:
+        return {
+            "set": {rel_path: props for rel_path, props in new.items() if old.get(rel_path) != props},
+            "del": [rel_path for rel_path in old if rel_path not in new],
+        }
+
+    @staticmethod
+    def _apply_delta(snapshot: dict, delta: dict):
+        for rel_path in delta.get("del", []):
+            snapshot.pop(rel_path, None)
+        snapshot.update(delta.get("set", {}))
+
+    def compact(self, keep_last: int = None, keep_days: float = None, thin_daily: bool = True, now: datetime = None) -> int:
+        """
+        Drop old entries according to a retention policy and return the number of serialized bytes freed.
+
+        An entry is kept if it is one of the `keep_last` most recent ones or is newer than `keep_days` days. Older
+        entries are thinned to the last one of each day if `thin_daily` is True, or dropped otherwise. The latest
+        entry is always kept. With both keep_last and keep_days set to None the policy is disabled.
+        """
+        if (keep_last is None) and (keep_days is None):
+            return 0
+        now = now or datetime.now()
+        keys = list(self._entries)
+        keep = set(keys[-max(int(keep_last or 0), 1):])
+        cutoff = now - timedelta(days=float(keep_days)) if keep_days is not None else None
+        last_of_day = {}
+        for key in keys:
+            try:
+                timestamp = datetime.strptime(key, self.KEY_FORMAT)
+            except (TypeError, ValueError):
+                keep.add(key)  # Not a timestamp, never drop what cannot be dated
+                continue
+            if (cutoff is not None) and (timestamp >= cutoff):
+                keep.add(key)
+            last_of_day[timestamp.date()] = key
+        if thin_daily:
+            keep.update(last_of_day.values())
+        dropped = [key for key in keys if key not in keep]
+        if not dropped:
+            return 0
+        size_before = self.serialized_size()
+        self._rebuild((key, snapshot) for key, snapshot in self.iter_snapshots() if key in keep)
+        freed = size_before - self.serialized_size()
+        logger.info(f"History compacted: {len(dropped)} of {len(keys)} syncs removed, {freed} bytes freed")
+        return freed
+
+    def serialized_size(self) -> int:
+        return len(json.dumps(self.to_dict(), separators=(",", ":")))
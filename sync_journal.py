@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("SYNC")
+
+
+class SyncJournal:
+    """
+    On-disk record of a running sync, used to resume it after a crash.
+
+    The file holds one JSON document per line: a header with the sync actions, one line per completed action with
+    the entries it contributes to the new common state, and a final line with the history key once the sync has
+    finished. Lines are flushed as they are written, so a sync killed at any point loses at most the actions that
+    were running. Lines cut by a crash are ignored.
+    """
+    VERSION = 1
+
+    def __init__(self, journal_file: str):
+        self._journal_file = journal_file
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def journal_file(self):
+        return self._journal_file
+
+    @staticmethod
+    def journal_file_for(cache_dir: str, folder_a: str, folder_b: str) -> str:
+        """Return the journal file of the pair of folders inside `cache_dir`."""
+        folders = "\0".join(os.path.normcase(os.path.abspath(folder)) for folder in (folder_a, folder_b))
+        return os.path.join(cache_dir, f"{hashlib.sha1(folders.encode('utf-8')).hexdigest()}.journal")
+
+    def exists(self) -> bool:
+        return os.path.isfile(self._journal_file)
+
+    def load(self):
+        """
+        Return the state of the journaled sync as {"actions", "results", "finished"}, or None if there is none.
+
+        "results" maps the completed actions' paths to their common state entries. "finished" is the history key
+        of the sync if it ran to the end, None otherwise.
+        """
+        if not self.exists():
+            return None
+        try:
+            with open(self._journal_file, "r") as f:
+                header = json.loads(f.readline())
+                if header.get("version") != self.VERSION:
+                    logger.warning(f"Ignoring sync journal with unknown version: \"{self._journal_file}\"")
+                    return None
+                state = {"actions": header["actions"], "results": {}, "finished": None}
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Line cut by a crash
+                    if "finished" in record:
+                        state["finished"] = record["finished"]
+                    else:
+                        state["results"][record["path"]] = record["result"]
+                return state
+        except Exception as e:
+            logger.error(f"Error reading sync journal \"{self._journal_file}\". Error: {str(e)}")
+            return None
+
+    def begin(self, actions: dict, resume: bool = False):
+        """Start journaling the sync of `actions`, or keep appending to the existing journal if `resume` is True."""
+        self.close()
+        os.makedirs(os.path.dirname(os.path.abspath(self._journal_file)), exist_ok=True)
+        if not resume:
+            tmp_file = f"{self._journal_file}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(json.dumps({"version": self.VERSION, "actions": actions}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self._journal_file)
+        self._file = open(self._journal_file, "a")
+        if resume:
+            self._file.write("\n")  # Terminate a line the crash may have cut
+
+    def record(self, rel_path: str, result: dict):
+        self._write({"path": rel_path, "result": result})
+
+    def finish(self, history_key: str):
+        self._write({"finished": history_key})
+        self.flush()
+
+    def _write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def flush(self):
+        """Write the journal through to the disk."""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self._journal_file)
+        except FileNotFoundError:
+            pass
@@ -4,18 +4,29 @@
 # - backup new and modified files
 # - recover a file version from a previous sync
 import errno
-import hashlib
 import json
 import os
 import logging
 import shutil
+import stat
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 
 from dotenv import load_dotenv
 from icecream import ic
 
+from file_copy import FileCopier
+from file_hash import FileHasher
+from folder_watcher import ChangeJournal, PollingWatcher, create_watcher
+from hash_cache import HashCache
+from sync_history import SyncHistory
+from sync_journal import SyncJournal
+from sync_progress import SyncProgress
+
 load_dotenv()
 DEBUG = bool(int(os.environ.get("DEBUG", 0)))
+TEMP_SUFFIX = ".ftpart"  # Files being copied, renamed into place once complete and never scanned
 
 
 def set_logger(logger_name, level=logging.WARNING, fmt='%(asctime)s - %(levelname)s - %(message)s', stream=True,
@@ -37,15 +48,54 @@ set_logger("SYNC", level=logging.DEBUG if DEBUG else logging.INFO, log_file="syn
 logger = logging.getLogger("SYNC")
 
 
+class SyncCancelled(Exception):
+    """Raised when a scan or sync is stopped through SyncManager.cancel()."""
 
 
 
 class SyncManager:
     def __init__(self, **kwargs):
         self._folder_a, self._folder_b = None, None
+        self._cache_dir = kwargs.get("cache_dir", None)
+        self._hash_cache_size = kwargs.get("hash_cache_size", HashCache.DEFAULT_MAX_ENTRIES)
+        self._hash_caches = {}
+        self._scan_workers = kwargs.get("scan_workers", 4)
+        self._scan_executor = kwargs.get("scan_executor", "thread")
+        self._scan_chunk_size = kwargs.get("scan_chunk_size", 16)
+        self._compare_mode = kwargs.get("compare_mode", "hash")
+        self._hasher = FileHasher(kwargs.get("hash_mode", "flat"),
+                                  kwargs.get("hash_buffer_size", FileHasher.DEFAULT_BUFFER_SIZE),
+                                  kwargs.get("hash_block_size", FileHasher.DEFAULT_BLOCK_SIZE),
+                                  kwargs.get("hash_detect_appends", False),
+                                  kwargs.get("hash_mmap_threshold", None),
+                                  kwargs.get("hash_function", "sha256"),
+                                  kwargs.get("hash_sample_size", FileHasher.DEFAULT_SAMPLE_SIZE))
+        self._sync_workers = kwargs.get("sync_workers", 4)
+        self._copier = FileCopier(kwargs.get("copy_backend", "auto"),
+                                  kwargs.get("copy_buffer_size", FileCopier.DEFAULT_BUFFER_SIZE),
+                                  delta_threshold=kwargs.get("delta_threshold", None),
+                                  delta_block_size=kwargs.get("delta_block_size", FileCopier.DEFAULT_DELTA_BLOCK_SIZE))
+        self._hashing_copier = FileCopier("buffered", self._copier.buffer_size,
+                                          delta_threshold=self._copier.delta_threshold,
+                                          delta_block_size=self._copier.delta_block_size)
+        self._cancel_event = threading.Event()
+        self._progress_listeners = []
+        self._progress = SyncProgress(self._report_progress)
+        self._last_run_summary = None
+        self._snapshots = {}
+        self._snapshot_lock = threading.Lock()
+        self._scan_generation = 0
+        self._watch_mode = kwargs.get("watch_mode", "off")
+        self._watch_poll_interval = kwargs.get("watch_poll_interval", PollingWatcher.DEFAULT_INTERVAL)
+        self._watch_poll_max_interval = kwargs.get("watch_poll_max_interval", PollingWatcher.DEFAULT_MAX_INTERVAL)
+        self._watchers = {}
         self._set_folder("A", kwargs.get("folder_a", None))
         self._set_folder("B", kwargs.get("folder_b", None))
-        self._history = kwargs.get("history", {})
+        self._history_rebase_interval = kwargs.get("history_rebase_interval", SyncHistory.DEFAULT_REBASE_INTERVAL)
+        self._history = SyncHistory.from_value(kwargs.get("history", {}), self._history_rebase_interval)
+        self._history_keep_last = kwargs.get("history_keep_last", None)
+        self._history_keep_days = kwargs.get("history_keep_days", None)
+        self._history_thin_daily = kwargs.get("history_thin_daily", True)
         self._future_common_state = {}
         self._sync_actions = {}
         # self._history_file = kwargs.get("history_file", "sync_history.json")
@@ -73,22 +123,76 @@ class SyncManager:
 
     @history.setter
     def history(self, value):
-        self._history = dict(value)
+        self._history = SyncHistory.from_value(value, self._history_rebase_interval)
 
     @property
     def sync_actions(self):
         return self._sync_actions
 
+    def add_progress_listener(self, callback):
+        """
+        Call `callback(event)` with the progress of the running scan or sync (see SyncProgress.event). It is called
+        from the worker threads, several times per second while files are scanned, hashed or copied.
+        """
+        self._progress_listeners.append(callback)
+
+    def remove_progress_listener(self, callback):
+        if callback in self._progress_listeners:
+            self._progress_listeners.remove(callback)
+
+    def _report_progress(self, event: dict):
+        for callback in list(self._progress_listeners):
+            callback(event)
+
+    @property
+    def last_run_summary(self):
+        """Per-phase timing of the last prep_sync or execute_sync, see SyncProgress.summary."""
+        return self._last_run_summary
+
+    def _finish_run(self, run: str, status: str):
+        self._last_run_summary = {"run": run, "status": status} | self._progress.summary()
+        logger.info(f"Run summary: {json.dumps(self._last_run_summary)}")
+
     @property
     def future_common_state(self):
         return self._future_common_state
 
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        """
+        Request the running scan or sync to stop as soon as possible. A request made while none is running cancels
+        the next one, so it is not lost between the steps of a caller running several of them.
+        """
+        self._cancel_event.set()
+        logger.info("Cancellation requested")
+
+    def clear_cancel(self):
+        """
+        Forget a cancellation request. Called when a scan or sync ends, so a cancellation (requested, or set to stop
+        the workers after an error) does not outlive it, and by callers running several steps once they are done.
+        """
+        self._cancel_event.clear()
+
     def get_latest_history(self):
-        return self._history[max(self._history.keys())] if self._history else None
+        return self._history.latest()
+
+    def compact_history(self) -> int:
+        """Apply the history retention policy, returns the number of serialized bytes freed."""
+        return self._history.compact(self._history_keep_last, self._history_keep_days, self._history_thin_daily)
+
+    def get_history_snapshot(self, key: str) -> dict:
+        """Rebuild the common state recorded by the sync identified by `key` (a key of `history`)."""
+        return self._history.snapshot(key)
 
     def _set_folder(self, which: str, value):
         if not value:
             setattr(self, f"_folder_{which.lower()}", None)
+            self._hash_caches.pop(which.lower(), None)
+            self.invalidate_snapshots(which)
+            self._stop_watcher(which)
             logger.debug(f"Folder {which.upper()} set to None")
             return
         # Assume the value is a valid directory, check only if it exists.
@@ -96,8 +200,22 @@ class SyncManager:
             logger.debug(f"Folder {which.upper()} does not exist and is being created: \"{value}\"")
             os.makedirs(value)
         setattr(self, f"_folder_{which.lower()}", value)
+        self._hash_caches.pop(which.lower(), None)
+        self.invalidate_snapshots(which)
+        if self._stop_watcher(which):
+            self.start_watching()
         logger.debug(f"Folder {which.upper()} set to: \"{value}\"")
 
+    def _get_hash_cache(self, which: str):
+        which = which.lower()
+        folder = getattr(self, f"_folder_{which}")
+        if not folder:
+            return None
+        if which not in self._hash_caches:
+            cache_file = HashCache.cache_file_for(self._cache_dir, folder) if self._cache_dir else None
+            self._hash_caches[which] = HashCache(cache_file, self._hash_cache_size)
+        return self._hash_caches[which]
+
     # def sync(self):
     #     """
     #     Synchronize files and folders between two directories.
@@ -194,33 +312,57 @@ class SyncManager:
     #     logger.info("Sync finished")
 
     def prep_sync(self):
+        self._progress.reset()
+        try:
+            sync_actions = self._prep_sync()
+        except BaseException as e:
+            self._finish_run("prep_sync", "cancelled" if isinstance(e, SyncCancelled) else "failed")
+            raise
+        finally:
+            self.clear_cancel()
+        self._finish_run("prep_sync", "finished")
+        return sync_actions
+
+    def _prep_sync(self):
         # Scan both folders for changes and update history
-        folder_states = [self.scan_folder(self.folder_a), self.scan_folder(self.folder_b)]
-        common_state = self._history[sorted(self._history.keys())[-1]] if self._history else {}
+        folder_states = self._scan_both()
+        common_state = self._history.latest() or {}
         self._sync_actions = {}
         self._future_common_state = {}
         # Run through all files in both folders and history
         union_list = set(list(folder_states[0].keys()) + list(folder_states[1].keys()) + list(common_state.keys()))
+        self._progress.begin("compare", len(union_list))
         for rel_path in union_list:
+            self._progress.advance("compare", path=rel_path)
             props_a = folder_states[0].get(rel_path, {})
             props_b = folder_states[1].get(rel_path, {})
             props_history = common_state.get(rel_path, {})
+            if self._compare_mode == "quick":
+                # Hashes were not computed by the scan, resolve them only where the metadata is not conclusive
+                read = bool(props_a and props_b)
+                if not (self._resolve_hash("a", rel_path, props_a, props_history, read) and
+                        self._resolve_hash("b", rel_path, props_b, props_history, read)):
+                    continue  # Unreadable file, leave it out of this sync
             if props_a and props_b:
                 # Exists in both folders
-                if props_a['hash'] == props_b['hash']:
+                same_hash = props_a['hash'] == props_b['hash']
+                identical = same_hash and self._same_content(rel_path, props_a, props_b, props_history)
+                if identical is None:
+                    continue  # Unreadable file, leave it out of this sync
+                if identical:
                     # Files/Folders are identical, no action needed
                     self._sync_actions[rel_path] = "no action"
                     self._future_common_state[rel_path] = props_a | {"tag": "unchanged" if props_history else "new a b"}
-                elif props_a['hash'] == props_history.get('hash'):
+                elif (not same_hash) and self._matches_history("a", rel_path, props_a, props_history):
                     # File B has changed, copy to A
                     self._sync_actions[rel_path] = "copy file to A"
                     self._future_common_state[rel_path] = props_b | {"tag": "updated b"}
-                elif props_b['hash'] == props_history.get('hash'):
+                elif (not same_hash) and self._matches_history("b", rel_path, props_b, props_history):
                     # File A has changed, copy to B
                     self._sync_actions[rel_path] = "copy file to B"
                     self._future_common_state[rel_path] = props_a | {"tag": "updated a"}
                 else:
-                    # Both files have changed, create conflict copies
+                    # Both files have changed (or only their samples are equal), create conflict copies
                     self._sync_actions[rel_path] = "conflict keep both"
                     self._future_common_state[rel_path] = {f"{k}_a": v for (k, v) in props_a.items() if k != "type"} | {
                         f"{k}_b": v for (k, v) in props_b.items() if k != "type"} | {"tag": "conflict",
@@ -257,82 +399,464 @@ class SyncManager:
                     else:
                         self._sync_actions[rel_path] = "create folder in A"
                     self._future_common_state[rel_path] = props_b | {"tag": "new b"}
+        self._progress.end("compare")
+        if self._compare_mode == "quick":
+            for which in "ab":
+                if self._get_hash_cache(which) is not None:
+                    self._get_hash_cache(which).save()
         return self._sync_actions
 
+    def _resolve_hash(self, which: str, rel_path: str, props: dict, props_history: dict, read: bool = True):
+        """
+        Fill in the hash of a file scanned without hashing (quick compare mode).
+
+        A file whose size and mtime match the last synced state is taken as unchanged and gets the hash recorded in
+        history. Otherwise the file is hashed on demand if `read` is True (the file exists on both sides and its
+        hash decides the action), or left as None when it is not needed to decide the action.
+        Returns False if the file could not be hashed.
+        """
+        if (not props) or (props.get("type") != "file") or (props.get("hash") is not None):
+            return True
+        if (props_history.get("type") == "file") and (props_history.get("hash") is not None) and \
+                (self.hash_algo(props_history) == self._hasher.algo) and \
+                (props["size"] == props_history.get("size")) and (props["mtime"] == props_history.get("mtime")):
+            props["hash"] = props_history["hash"]
+        elif read:
+            folder = getattr(self, f"_folder_{which}")
+            cache = self._get_hash_cache(which)
+            full_path = os.path.join(folder, rel_path)
+            try:
+                if cache is not None:
+                    props["hash"] = cache.get_hash(rel_path, full_path, self._hasher)
+                else:
+                    props["hash"] = self._hasher.hash_file(full_path)
+            except Exception as e:
+                logger.error(f"Error calculating hash for file \"{full_path}\": {str(e)}")
+                return False
+        else:
+            return True
+        if self._hasher.algo != FileHasher.DEFAULT_ALGO:
+            props["hash_algo"] = self._hasher.algo
+        return True
+
+    @staticmethod
+    def hash_algo(props: dict) -> str:
+        """Return the kind of hash (FileHasher.algo) of a file's props, entries without one are plain SHA-256."""
+        return props.get("hash_algo", FileHasher.DEFAULT_ALGO)
+
+    def _matches_history(self, which: str, rel_path: str, props: dict, props_history: dict) -> bool:
+        """
+        Return True if the file `rel_path` of folder `which` has the content recorded in history.
+
+        If the history hash is of another kind than the scan hash (the hash settings were changed since the last
+        sync), the file is hashed again the way the history was, so the change of settings alone never shows up as
+        a modified file.
+        """
+        if props_history.get("hash") is None:
+            return False
+        if (props.get("type") != "file") or (self.hash_algo(props) == self.hash_algo(props_history)):
+            return props["hash"] == props_history["hash"]
+        hasher = FileHasher.from_algo(self.hash_algo(props_history), self._hasher.buffer_size,
+                                      self._hasher.mmap_threshold)
+        if hasher is None:
+            logger.warning(f"Unknown hash algorithm in history for \"{rel_path}\": {self.hash_algo(props_history)}")
+            return False
+        full_path = os.path.join(getattr(self, f"_folder_{which}"), rel_path)
+        try:
+            return hasher.hash_file(full_path) == props_history["hash"]
+        except Exception as e:
+            logger.error(f"Error calculating hash for file \"{full_path}\": {str(e)}")
+            return False
+
+    def _same_content(self, rel_path: str, props_a: dict, props_b: dict, props_history: dict):
+        """
+        Confirm that two files with the same hash have the same content, return None if a file cannot be read.
+
+        A sample hash only means "maybe equal", so in sample mode both files are hashed in full, unless both still
+        have the size, mtime and hash the last sync recorded for them (the content was confirmed then).
+        """
+        if (props_a.get("type") != "file") or (self._hasher.mode != "sample"):
+            return True
+        if all(props_a.get(k) == props_b.get(k) == props_history.get(k) for k in ("size", "mtime", "hash")):
+            return True
+        hasher = FileHasher("flat", self._hasher.buffer_size, mmap_threshold=self._hasher.mmap_threshold,
+                            function=self._hasher.function)
+        full_hashes = []
+        for which in "ab":
+            full_path = os.path.join(getattr(self, f"_folder_{which}"), rel_path)
+            try:
+                full_hashes.append(hasher.hash_file(full_path))
+            except Exception as e:
+                logger.error(f"Error calculating hash for file \"{full_path}\": {str(e)}")
+                return None
+        if full_hashes[0] != full_hashes[1]:
+            logger.warning(f"Files \"{rel_path}\" have the same sample hash but a different content")
+        return full_hashes[0] == full_hashes[1]
+
     def modify_action(self, rel_path: str, new_action: str):
         if rel_path not in self._sync_actions:
             raise ValueError(f"No action found for file/folder \"{rel_path}\"")
         self._sync_actions[rel_path] = new_action
 
-    def execute_sync(self, sync_actions: dict = None):
+    def skip_action(self, rel_path: str):
+        """Leave `rel_path` out of the sync, the next prep_sync finds it again."""
+        if rel_path not in self._sync_actions:
+            raise ValueError(f"No action found for file/folder \"{rel_path}\"")
+        del self._sync_actions[rel_path]
+        self._future_common_state.pop(rel_path, None)
+
+    def execute_sync(self, sync_actions: dict = None, resume: bool = False):
+        """
+        Execute the sync actions and record the resulting common state in the history.
+
+        The actions are run in dependency order (see _plan_sync) on a pool of `sync_workers` threads. The history
+        snapshot is the same as when running the actions one by one. With a cache_dir, every completed action is
+        recorded in a SyncJournal, and with `resume` the actions already completed by the journaled sync are
+        skipped (see resume_sync).
+        """
         if not sync_actions:
             sync_actions = self._sync_actions
+        self._progress.reset()
+        try:
+            self._execute_sync(sync_actions, resume)
+        except BaseException as e:
+            self._finish_run("execute_sync", "cancelled" if isinstance(e, SyncCancelled) else "failed")
+            raise
+        finally:
+            self.clear_cancel()
+        self._finish_run("execute_sync", "finished")
+
+    def _execute_sync(self, sync_actions: dict, resume: bool):
+        journal = self._get_journal()
+        results = {}
+        if journal is not None:
+            state = journal.load() if resume else None
+            if state:
+                results = dict(state["results"])
+                logger.info(f"Resuming sync: {len(results)} of {len(sync_actions)} actions already completed")
+            journal.begin(sync_actions, resume=bool(state))
+        try:
+            with ThreadPoolExecutor(max_workers=max(int(self._sync_workers or 1), 1), thread_name_prefix="sync") as pool:
+                # The plan is made from all the actions, so resuming takes the same decisions as the first run
+                for phase_name, phase in self._plan_sync(sync_actions):
+                    phase = [(rel_path, action) for rel_path, action in phase if rel_path not in results]
+                    progress_phase = f"sync {phase_name}"
+                    self._progress.begin(progress_phase, len(phase),
+                                         sum(self._copy_size(rel_path, action) for rel_path, action in phase))
+                    futures = {pool.submit(self._run_journaled, rel_path, action, journal, progress_phase): rel_path
+                               for rel_path, action in phase}
+                    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                    errors = [future.exception() for future in done if future.exception()]
+                    if errors:
+                        self._cancel_event.set()  # Stop the actions of this phase that did not start yet
+                        wait(futures)
+                        raise errors[0]
+                    for future, rel_path in futures.items():
+                        results[rel_path] = future.result()
+                    if journal is not None:
+                        journal.flush()
+                    self._progress.end(progress_phase)
+        except BaseException:
+            if journal is not None:
+                journal.close()
+            self.invalidate_snapshots("".join(which for which in "ab" if not self.is_watching(which)))
+            raise
+        finally:
+            # Keep the hashes of the copied files, the next scan does not have to read them
+            for which in "ab":
+                if self._get_hash_cache(which) is not None:
+                    self._get_hash_cache(which).save()
         new_common_list = {}
+        for rel_path in sync_actions:
+            new_common_list.update(results.get(rel_path, {}))
+        # Reset common state and sync actions, the folders have changed so the scan snapshots are stale unless a
+        # watcher journaled the changes
+        self._future_common_state = {}
+        self._sync_actions = {}
+        self.invalidate_snapshots("".join(which for which in "ab" if not self.is_watching(which)))
+        # Update history
+        history_key = datetime.now().strftime(SyncHistory.KEY_FORMAT)
+        self._history.add(history_key, new_common_list)
+        if journal is not None:
+            journal.finish(history_key)
+            journal.close()
+
+    def _run_journaled(self, rel_path: str, action: str, journal: SyncJournal = None, progress_phase: str = None) -> dict:
+        result = self._run_action(rel_path, action)
+        if journal is not None:
+            journal.record(rel_path, result)
+        if progress_phase is not None:
+            self._progress.advance(progress_phase, size=self._copy_size(rel_path, action), path=rel_path)
+        return result
+
+    def _copy_size(self, rel_path: str, action: str) -> int:
+        """Return the size of the file copied by a sync action as found by the last scan, 0 if none or unknown."""
+        if action.startswith("copy file to "):
+            source = "b" if action.endswith("A") else "a"
+        elif action.startswith("conflict") and action.endswith(("keep A", "keep B")):
+            source = action[-1].lower()
+        else:
+            return 0
+        with self._snapshot_lock:
+            snapshot = self._snapshots.get(source)
+            props = snapshot["state"].get(rel_path) if snapshot else None
+        return (props or {}).get("size", 0)
+
+    def _get_journal(self):
+        if not (self._cache_dir and self._folder_a and self._folder_b):
+            return None
+        return SyncJournal(SyncJournal.journal_file_for(self._cache_dir, self._folder_a, self._folder_b))
+
+    def get_interrupted_sync(self):
+        """Return the actions of a journaled sync that did not finish, or None."""
+        journal = self._get_journal()
+        state = journal.load() if journal is not None else None
+        if not state:
+            return None
+        if (state["finished"] is not None) and (state["finished"] in self._history):
+            journal.discard()  # Finished and recorded in the history, the journal was just not discarded yet
+            return None
+        return state["actions"]
+
+    def resume_sync(self):
+        """
+        Finish an interrupted sync: run the actions it did not complete and record it in the history, without
+        running prep_sync again.
+        """
+        journal = self._get_journal()
+        state = journal.load() if journal is not None else None
+        if not state:
+            raise ValueError("No interrupted sync to resume")
+        if state["finished"] is None:
+            self.execute_sync(state["actions"], resume=True)
+        elif state["finished"] not in self._history:
+            # All the actions completed, only the history entry was lost
+            new_common_list = {}
+            for rel_path in state["actions"]:
+                new_common_list.update(state["results"].get(rel_path, {}))
+            self._history.add(state["finished"], new_common_list)
+            logger.info(f"Sync of {state['finished']} restored from the journal")
+
+    def discard_sync_journal(self):
+        """Delete the sync journal, to be called once the history of the last sync has been saved."""
+        journal = self._get_journal()
+        if journal is not None:
+            journal.discard()
+
+    @staticmethod
+    def _plan_sync(sync_actions: dict) -> list:
+        """
+        Split the sync actions in phases that can each run in parallel: folders are created first, then files are
+        copied (and conflicts resolved), then files are deleted and finally folders are deleted. Returns the
+        non-empty phases as (name, [(rel_path, action)]). Folder deletions
+        covered by the deletion of a parent folder on the same side are dropped, and so are the ones that contain a
+        file being copied from that side, as the copy would otherwise be undone.
+        """
+        phases = {"create": [], "copy": [], "delete file": [], "delete folder": []}
         for rel_path, action in sync_actions.items():
-            if action == "no action":
-                new_common_list[rel_path] = self.get_props(str(os.path.join(self.folder_a, rel_path)), rel_path)
-            elif action == "copy file to A":
-                self._copy_file(self.folder_b, self.folder_a, rel_path)
-                new_common_list[rel_path] = self.get_props(str(os.path.join(self.folder_b, rel_path)), rel_path)
-            elif action == "copy file to B":
-                self._copy_file(self.folder_a, self.folder_b, rel_path)
-                new_common_list[rel_path] = self.get_props(str(os.path.join(self.folder_a, rel_path)), rel_path)
-            elif action == "create folder in A":
-                self._create_folder(self.folder_a, rel_path)
-                new_common_list[rel_path] = self.get_props(str(os.path.join(self.folder_b, rel_path)), rel_path)
-            elif action == "create folder in B":
-                self._create_folder(self.folder_b, rel_path)
-                new_common_list[rel_path] = self.get_props(str(os.path.join(self.folder_a, rel_path)), rel_path)
-            elif action == "delete file from A":
-                self._delete_file(self.folder_a, rel_path)
-            elif action == "delete file from B":
-                self._delete_file(self.folder_b, rel_path)
-            elif action == "delete folder from A":
-                self._delete_folder(self.folder_a, rel_path)
-            elif action == "delete folder from B":
-                self._delete_folder(self.folder_b, rel_path)
+            if action.startswith("create folder"):
+                phases["create"].append((rel_path, action))
+            elif action.startswith("delete file"):
+                phases["delete file"].append((rel_path, action))
+            elif action.startswith("delete folder"):
+                phases["delete folder"].append((rel_path, action))
+            elif (action in ("no action", "copy file to A", "copy file to B")) or \
+                    (action.startswith("conflict") and action.endswith(("keep A", "keep B", "both"))):
+                phases["copy"].append((rel_path, action))
             elif action.startswith("conflict"):
-                props_a = self.get_props(str(os.path.join(self._folder_a, rel_path)), rel_path)
-                props_b = self.get_props(str(os.path.join(self._folder_b, rel_path)), rel_path)
-                if action.endswith("keep A"):
-                    self._copy_file(self.folder_a, self.folder_b, rel_path)
-                    new_common_list[rel_path] = props_a
-                elif action.endswith("keep B"):
-                    self._copy_file(self.folder_b, self.folder_a, rel_path)
-                    new_common_list[rel_path] = props_b
-                elif action.endswith("both"):
-                    new_file_a, new_file_b = self._handle_conflict(rel_path, props_a, props_b)
-                    new_common_list[new_file_a] = self.get_props(str(os.path.join(self.folder_a, new_file_a)), new_file_a)
-                    new_common_list[new_file_b] = self.get_props(str(os.path.join(self.folder_b, new_file_b)), new_file_b)
-                else:
-                    logger.error(f"Invalid conflict resolution action: {action}")
-                    raise ValueError(f"Invalid conflict resolution action: {action}")
+                logger.error(f"Invalid conflict resolution action: {action}")
+                raise ValueError(f"Invalid conflict resolution action: {action}")
             else:
                 logger.error(f"Invalid action: {action}")
                 raise ValueError(f"Invalid action: {action}")
-        # Reset common state and sync actions
-        self._future_common_state = {}
-        self._sync_actions = {}
-        # Update history
-        self._history[datetime.now().strftime("%Y-%m-%d %H:%M:%S")] = new_common_list
+        phases["create"].sort(key=lambda item: item[0].count(os.sep))
+
+        def parent_deleted(rel_path, side):
+            parent = os.path.dirname(rel_path)
+            while parent:
+                if (side, parent) in deleted_folders:
+                    return True
+                parent = os.path.dirname(parent)
+            return False
+
+        copy_sources = {("B" if action.endswith("A") else "A", rel_path) for rel_path, action in phases["copy"]
+                        if action.startswith("copy")}
+        kept_folders = {(side, os.path.dirname(rel_path)) for side, rel_path in copy_sources}
+        for side, parent in list(kept_folders):
+            while parent:
+                parent = os.path.dirname(parent)
+                kept_folders.add((side, parent))
+        deleted_folders = set()
+        for rel_path, action in phases["delete folder"]:
+            if (action[-1], rel_path) in kept_folders:
+                logger.warning(f"Folder not deleted, files are copied from it: \"{rel_path}\" ({action})")
+            else:
+                deleted_folders.add((action[-1], rel_path))
+        phases["delete folder"] = [(rel_path, action) for rel_path, action in phases["delete folder"]
+                                   if ((action[-1], rel_path) in deleted_folders) and
+                                   not parent_deleted(rel_path, action[-1])]
+        return [(name, phase) for name, phase in phases.items() if phase]
+
+    def _run_action(self, rel_path: str, action: str) -> dict:
+        """Run one sync action and return the entries it contributes to the new common state."""
+        self._check_cancelled(self._cancel_event, rel_path, "Sync")
+        if action == "no action":
+            return {rel_path: self._current_props("a", rel_path)}
+        if action == "copy file to A":
+            return self._copy_entry(rel_path, self._copy("b", "a", rel_path))
+        if action == "copy file to B":
+            return self._copy_entry(rel_path, self._copy("a", "b", rel_path))
+        if action == "create folder in A":
+            self._create_folder(self.folder_a, rel_path)
+            return {rel_path: self.get_props(str(os.path.join(self.folder_b, rel_path)), rel_path)}
+        if action == "create folder in B":
+            self._create_folder(self.folder_b, rel_path)
+            return {rel_path: self.get_props(str(os.path.join(self.folder_a, rel_path)), rel_path)}
+        if action == "delete file from A":
+            self._delete_file(self.folder_a, rel_path)
+        elif action == "delete file from B":
+            self._delete_file(self.folder_b, rel_path)
+        elif action == "delete folder from A":
+            self._delete_folder(self.folder_a, rel_path)
+        elif action == "delete folder from B":
+            self._delete_folder(self.folder_b, rel_path)
+        elif action.startswith("conflict"):
+            if action.endswith("keep A"):
+                return self._copy_entry(rel_path, self._copy("a", "b", rel_path))
+            if action.endswith("keep B"):
+                return self._copy_entry(rel_path, self._copy("b", "a", rel_path))
+            return self._handle_conflict(rel_path, self._current_props("a", rel_path),
+                                         self._current_props("b", rel_path))
+        return {}
+
+    def _copy_entry(self, rel_path: str, copy_result: tuple) -> dict:
+        """
+        Return the common state entry of a copy made by _copy(). If the copy did not complete, the destination still
+        has its old content, so the previous entry is kept (none for a new file) and the next sync copies it again.
+        """
+        src_props, dest_props = copy_result
+        return {rel_path: src_props} if dest_props is not None else self._previous_entry(rel_path)
+
+    def _previous_entry(self, rel_path: str) -> dict:
+        previous = (self._history.latest() or {}).get(rel_path)
+        return {rel_path: previous} if previous is not None else {}
+
+    def _current_props(self, which: str, rel_path: str) -> dict:
+        """
+        Return the props of `rel_path` in folder `which`, reusing the ones of the prep_sync scan while the entry's
+        size, mtime and ctime are unchanged. Otherwise the file is hashed again (through the hash cache).
+        """
+        full_path = os.path.join(getattr(self, f"_folder_{which}"), rel_path)
+        stat_result = os.stat(full_path)
+        is_dir = stat.S_ISDIR(stat_result.st_mode)
+        with self._snapshot_lock:
+            snapshot = self._snapshots.get(which)
+            props = snapshot["state"].get(rel_path) if snapshot else None
+        if props and (props.get("hash") is not None) and \
+                (props == self._props_from_stat(stat_result, is_dir, props["hash"], self.hash_algo(props))):
+            return dict(props)
+        return self._props_from_stat(stat_result, is_dir, self._get_hash(full_path, rel_path, stat_result, is_dir,
+                                                                        self._get_hash_cache(which), True,
+                                                                        self._hasher), self._hasher.algo)
+
+    def _copy(self, src_which: str, dest_which: str, src_relpath: str, dest_relpath: str = None) -> tuple:
+        """
+        Copy a file between the synced folders and return the props of the source and of the copy.
+
+        The hash is the one computed while copying, or for the kernel copy backends, which do not see the data, the
+        one from the prep_sync scan if the source is unchanged. It is stored in the destination's hash cache. The
+        props of the copy are None if the copy failed or the source changed while it was being copied.
+        """
+        dest_relpath = dest_relpath or src_relpath
+        dest_path = os.path.join(getattr(self, f"_folder_{dest_which}"), dest_relpath)
+        copier = self._copier
+        if copier.backend == "auto":
+            with self._snapshot_lock:
+                snapshot = self._snapshots.get(src_which)
+                scanned_props = snapshot["state"].get(src_relpath) if snapshot else None
+            if not (scanned_props and scanned_props.get("hash")):
+                copier = self._hashing_copier  # Hash unknown (quick compare mode), read the data once for both
+        hash_stream = self._hasher.stream()
+        src_props = self._copy_file(getattr(self, f"_folder_{src_which}"), getattr(self, f"_folder_{dest_which}"),
+                                    src_relpath, dest_relpath, copier, hash_stream, self._hasher.algo)
+        if src_props is None:
+            return self._current_props(src_which, src_relpath), None
+        blocks = getattr(hash_stream, "blocks", None)
+        if src_props["hash"] is None:
+            current_props = self._current_props(src_which, src_relpath)
+            if {k: v for k, v in current_props.items() if k not in ("hash", "hash_algo")} != \
+                    {k: v for k, v in src_props.items() if k not in ("hash", "hash_algo")}:
+                return current_props, None
+            src_props, blocks = current_props, None
+        dest_stat = os.stat(dest_path)
+        cache = self._get_hash_cache(dest_which)
+        if cache is not None:
+            cache.store(dest_relpath, dest_stat, src_props["hash"], self.hash_algo(src_props),
+                        blocks if self.hash_algo(src_props) == self._hasher.algo else None)
+        return src_props, self._props_from_stat(dest_stat, False, src_props["hash"], self.hash_algo(src_props))
 
     @staticmethod
-    def _copy_file(src_folder: str, dest_folder: str, src_relpath: str, dest_relpath: str = None):
+    def _copy_file(src_folder: str, dest_folder: str, src_relpath: str, dest_relpath: str = None,
+                   copier: FileCopier = None, hash_stream=None, hash_algo: str = FileHasher.DEFAULT_ALGO) -> dict:
+        """
+        Copy a file with its metadata using `copier` (buffered by default), hashing the data as it is copied with
+        `hash_stream` (FileHasher.stream(), a plain SHA-256 by default), which computes `hash_algo` hashes.
+
+        Files are copied to a temporary file renamed over the destination. Large files that already exist at the
+        destination are instead patched if the copier's delta transfer is enabled (see FileCopier.patch): the
+        destination is first copied to the temporary file on its own device (a reflink or an in-kernel copy when
+        the filesystem supports it), which is then patched and renamed over the destination.
+        Returns the props of the source file, with the hash set to None if the copy backend did not hash the data
+        or the source changed during the copy, or None if the copy failed.
+        """
         if not dest_relpath:
             dest_relpath = src_relpath
         src_path = os.path.join(src_folder, src_relpath)
         dst_path = os.path.join(dest_folder, dest_relpath)
+        tmp_path = dst_path + TEMP_SUFFIX
         try:
             os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-            if os.path.exists(dst_path):
-                os.remove(dst_path)  # Remove the existing file to avoid any issues with permissions
-            shutil.copy2(src_path, dst_path)
+            # Copy to a temporary file renamed over the destination, so it is never left truncated or missing
+            copier = copier or FileCopier("buffered")
+            hasher = hash_stream if hash_stream is not None else FileHasher().stream()
+            with open(src_path, "rb", buffering=0) as fsrc:
+                src_stat = os.fstat(fsrc.fileno())
+                if copier.use_delta(src_stat.st_size, dst_path):
+                    # Never patch the destination itself, an error or a crash would leave it half updated
+                    with open(dst_path, "rb", buffering=0) as fold, open(tmp_path, "wb", buffering=0) as fdst:
+                        FileCopier().copy(fold, fdst)
+                    with open(tmp_path, "r+b", buffering=0) as fdst:
+                        written = copier.patch(fsrc, fdst, hasher)
+                    backend = "delta"
+                    logger.debug(f"Delta copy: {written} of {src_stat.st_size} bytes written to \"{dst_path}\"")
+                else:
+                    with open(tmp_path, "wb", buffering=0) as fdst:
+                        backend = copier.copy(fsrc, fdst, hasher)
+            shutil.copystat(src_path, tmp_path)
+            try:
+                os.replace(tmp_path, dst_path)
+            except PermissionError:
+                if not os.path.isfile(dst_path):
+                    raise
+                os.chmod(dst_path, stat.S_IREAD | stat.S_IWRITE)  # Read-only destination (Windows)
+                os.replace(tmp_path, dst_path)
+            if HashCache.signature(os.stat(src_path)) != HashCache.signature(src_stat):
+                logger.warning(f"File changed while being copied: \"{src_path}\"")
+                return SyncManager._props_from_stat(src_stat, False, None)
+            return SyncManager._props_from_stat(src_stat, False,
+                                                hasher.hexdigest() if backend in FileCopier.HASHING_BACKENDS else None,
+                                                hash_algo)
         except PermissionError:
             logger.error(f"Permission denied when copying file: \"{src_path}\" -> \"{dst_path}\"")
         except FileNotFoundError:
             logger.error(f"Source file not found: \"{src_path}\"")
         except Exception as e:
             logger.error(f"Error copying file: \"{src_path}\" -> \"{dst_path}\". Error: {str(e)}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
 
     @staticmethod
     def _create_folder(folder: str, folder_relpath: str):
@@ -390,63 +914,432 @@ class SyncManager:
         except Exception as e:
             logger.error(f"Unexpected error deleting folder: \"{folder_path}\". Error: {str(e)}")
 
-    def _handle_conflict(self, file_relpath, file_a, file_b):
-        # Create conflict copies in both folders
+    def _handle_conflict(self, file_relpath, file_a, file_b) -> dict:
+        """Replace both versions of a conflicting file by conflict copies and return their new common state."""
         relpath, ext = os.path.splitext(file_relpath)
         conflict_name_a = f"{relpath}_A{ext}"
         conflict_name_b = f"{relpath}_B{ext}"
         try:
-            # Copy A's version to both folders
-            self._copy_file(self.folder_a, self.folder_a, file_relpath, conflict_name_a)
-            self._copy_file(self.folder_a, self.folder_b, file_relpath, conflict_name_a)
-            # Copy B's version to both folders
-            self._copy_file(self.folder_b, self.folder_a, file_relpath, conflict_name_b)
-            self._copy_file(self.folder_b, self.folder_b, file_relpath, conflict_name_b)
+            # Copy A's version to both folders, then B's version (the props of a copy are None if it failed)
+            copies = {conflict_name_a: [self._copy("a", "a", file_relpath, conflict_name_a)[1],
+                                        self._copy("a", "b", file_relpath, conflict_name_a)[1]]}
+            copy_b_to_a = self._copy("b", "a", file_relpath, conflict_name_b)[1]
+            copies[conflict_name_b] = [self._copy("b", "b", file_relpath, conflict_name_b)[1], copy_b_to_a]
+            # Only the names copied to both folders are in sync
+            new_state = {name: props[0] for name, props in copies.items() if None not in props}
+            if len(new_state) < len(copies):
+                logger.error(f"Conflict copies of file \"{file_relpath}\" failed, the original files are kept")
+                return new_state | self._previous_entry(file_relpath)
             # Delete original files
             self._delete_file(self.folder_a, file_relpath)
             self._delete_file(self.folder_b, file_relpath)
             logger.info(
                 f"Conflict handled for file: \"{file_relpath}\". Created copies: \"{conflict_name_a}\" and \"{conflict_name_b}\"")
-            return conflict_name_a, conflict_name_b
+            return new_state
         except Exception as e:
             logger.error(f"Error handling conflict for file: \"{file_relpath}\". Error: {str(e)}")
+            return {}
 
     @staticmethod
     def calculate_file_hash(file_path: str) -> str:
-        hasher = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                hasher.update(chunk)
-        return hasher.hexdigest()
+        return FileHasher().hash_file(file_path)
+
+    @staticmethod
+    def get_props(full_path: str, rel_path: str = None, cache: HashCache = None, hash_files: bool = True,
+                  hasher: FileHasher = None) -> dict:
+        hasher = hasher or FileHasher()
+        stat_result = os.stat(full_path)
+        is_dir = stat.S_ISDIR(stat_result.st_mode)
+        return SyncManager._props_from_stat(stat_result, is_dir,
+                                            SyncManager._get_hash(full_path, rel_path, stat_result, is_dir, cache,
+                                                                  hash_files, hasher), hasher.algo)
 
     @staticmethod
-    def get_props(full_path: str, rel_path: str = None) -> dict:
-        return {
-            "type": "folder" if os.path.isdir(full_path) else "file",
-            "ctime": os.path.getctime(full_path),
-            "mtime": os.path.getmtime(full_path),
-            "hash": SyncManager.calculate_file_hash(full_path) if os.path.isfile(full_path) else rel_path,
-            "size": os.path.getsize(full_path) if os.path.isfile(full_path) else 0,
+    def _get_hash(full_path: str, rel_path: str, stat_result: os.stat_result, is_dir: bool, cache: HashCache = None,
+                  hash_files: bool = True, hasher: FileHasher = None):
+        hasher = hasher or FileHasher()
+        if is_dir or not stat.S_ISREG(stat_result.st_mode):
+            return rel_path
+        if (cache is not None) and (rel_path is not None):
+            if not hash_files:
+                # Only use a hash that is already known, the caller hashes on demand
+                return cache.lookup(rel_path, stat_result, hasher.algo)
+            return cache.get_hash(rel_path, full_path, hasher, stat_result)
+        return hasher.hash_file(full_path) if hash_files else None
+
+    @staticmethod
+    def _props_from_stat(stat_result: os.stat_result, is_dir: bool, file_hash: str,
+                         hash_algo: str = FileHasher.DEFAULT_ALGO) -> dict:
+        props = {
+            "type": "folder" if is_dir else "file",
+            "ctime": stat_result.st_ctime,
+            "mtime": stat_result.st_mtime,
+            "hash": file_hash,
+            "size": stat_result.st_size if stat.S_ISREG(stat_result.st_mode) else 0,
         }
+        if (hash_algo != FileHasher.DEFAULT_ALGO) and (file_hash is not None) and stat.S_ISREG(stat_result.st_mode):
+            props["hash_algo"] = hash_algo  # Plain SHA-256 hashes are left unmarked, like the ones of older versions
+        return props
+
+    @staticmethod
+    def _hash_batch(items: list, hasher: FileHasher = None) -> list:
+        # Runs inside the worker pool, so errors are returned instead of raised to keep the other results.
+        # Items are (full_path, known_blocks, known_size), results are (hash, blocks, error).
+        hasher = hasher or FileHasher()
+        results = []
+        for full_path, known_blocks, known_size in items:
+            try:
+                if hasher.mode == "tree":
+                    results.append(hasher.hash_blocks(full_path, known_blocks, known_size) + (None,))
+                else:
+                    results.append((hasher.hash_file(full_path), None, None))
+            except Exception as e:
+                results.append((None, None, str(e)))
+        return results
+
+    @staticmethod
+    def scan_folder(folder: str, cache: HashCache = None, workers: int = 1, executor: str = "thread",
+                    chunk_size: int = 16, cancel_event: threading.Event = None, hash_files: bool = True,
+                    hasher: FileHasher = None, progress: SyncProgress = None, label: str = "") -> dict:
+        """
+        Scan `folder` and return a map of relative path -> props (type, ctime, mtime, hash, size and, for hashes
+        other than plain SHA-256, hash_algo). Files are hashed with `hasher` (plain SHA-256 by default).
+
+        With hash_files=False only hashes still valid in `cache` are filled in, the other files get a None hash.
+        The entries scanned and the files hashed are counted in the "scan <label>" and "hash <label>" phases of
+        `progress`.
+        """
+        hasher = hasher or FileHasher()
+        if progress is not None:
+            progress.begin(f"scan {label}".strip())
+        try:
+            if workers and workers > 1:
+                fmap = SyncManager._scan_folder_concurrent(folder, cache, workers, executor, chunk_size, cancel_event,
+                                                           hash_files, hasher, progress, label)
+            else:
+                fmap = SyncManager._scan_folder_sequential(folder, cache, cancel_event, hash_files, hasher,
+                                                           progress, label)
+        except SyncCancelled:
+            if cache is not None:
+                cache.save()  # Keep the hashes computed so far, the partial map must not be used for pruning
+            raise
+        finally:
+            if progress is not None:
+                progress.end(f"scan {label}".strip())
+                progress.end(f"hash {label}".strip())
+        if cache is not None:
+            cache.prune(fmap.keys())
+            cache.save()
+        return fmap
+
+    @staticmethod
+    def _check_cancelled(cancel_event: threading.Event, path: str, operation: str = "Scan"):
+        if (cancel_event is not None) and cancel_event.is_set():
+            raise SyncCancelled(f"{operation} of \"{path}\" cancelled")
+
+    @staticmethod
+    def walk_folder(folder: str, cancel_event: threading.Event = None):
+        """
+        Yield (rel_path, full_path, stat_result, is_dir) for every file and folder below `folder`.
+
+        Built on os.scandir so each entry costs a single (cached) stat call, which matters on network shares where
+        every call is a round trip. Like os.walk, symbolic links to folders are reported but not followed.
+        Temporary files of copies in progress (TEMP_SUFFIX) are skipped.
+        """
+        stack = [("", folder)]
+        while stack:
+            SyncManager._check_cancelled(cancel_event, folder)
+            rel_dir, dir_path = stack.pop()
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = list(it)
+            except OSError as e:
+                logger.error(f"Error listing folder \"{dir_path}\": {str(e)}")
+                continue
+            subdirs = []
+            for entry in entries:
+                if entry.name.endswith(TEMP_SUFFIX):
+                    continue
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                try:
+                    stat_result = entry.stat()
+                except OSError as e:
+                    logger.error(f"Error reading properties of \"{entry.path}\": {str(e)}")
+                    continue
+                is_dir = stat.S_ISDIR(stat_result.st_mode)
+                if is_dir and entry.is_dir(follow_symlinks=False):
+                    subdirs.append((rel_path, entry.path))
+                yield rel_path, entry.path, stat_result, is_dir
+            stack.extend(reversed(subdirs))
 
     @staticmethod
-    def scan_folder(folder: str) -> dict:
+    def _scan_folder_sequential(folder: str, cache: HashCache, cancel_event: threading.Event,
+                                hash_files: bool = True, hasher: FileHasher = None, progress: SyncProgress = None,
+                                label: str = "") -> dict:
+        hasher = hasher or FileHasher()
         fmap = {}
-        for root, dirs, files in os.walk(folder):
-            for local_name in dirs + files:
-                full_path = os.path.join(root, local_name)
+        scan_phase, hash_phase = f"scan {label}".strip(), f"hash {label}".strip()
+        if progress is not None:
+            progress.begin(hash_phase)
+        for rel_path, full_path, stat_result, is_dir in SyncManager.walk_folder(folder, cancel_event):
+            SyncManager._check_cancelled(cancel_event, folder)
+            try:
+                misses = cache.misses if cache is not None else 0
+                file_hash = SyncManager._get_hash(full_path, rel_path, stat_result, is_dir, cache, hash_files, hasher)
+                fmap[rel_path] = SyncManager._props_from_stat(stat_result, is_dir, file_hash, hasher.algo)
+                if progress is not None:
+                    size = fmap[rel_path]["size"]
+                    progress.advance(scan_phase, size=size, path=rel_path)
+                    if (not is_dir) and hash_files and stat.S_ISREG(stat_result.st_mode) and \
+                            ((cache is None) or (cache.misses != misses)):
+                        progress.advance(hash_phase, size=size, path=rel_path)
+            except Exception as e:
+                logger.error(f"Error calculating hash for {'directory' if is_dir else 'file'} \"{full_path}\": {str(e)}")
+        return fmap
+
+    @staticmethod
+    def _scan_folder_concurrent(folder: str, cache: HashCache, workers: int, executor: str, chunk_size: int,
+                                cancel_event: threading.Event, hash_files: bool = True, hasher: FileHasher = None,
+                                progress: SyncProgress = None, label: str = "") -> dict:
+        """
+        Scan `folder` hashing files on a thread or process pool.
+
+        The tree is walked and stat'ed first, cache hits are resolved in the calling thread and the remaining files
+        are sent to the pool in batches of `chunk_size`, smallest files first, so a few large files do not hold back
+        the bulk of small ones. Returns the same map as the sequential scan.
+        """
+        hasher = hasher or FileHasher()
+        fmap = {}
+        pending = []
+        scan_phase, hash_phase = f"scan {label}".strip(), f"hash {label}".strip()
+        for rel_path, full_path, stat_result, is_dir in SyncManager.walk_folder(folder, cancel_event):
+            if progress is not None:
+                progress.advance(scan_phase, size=stat_result.st_size if stat.S_ISREG(stat_result.st_mode) else 0,
+                                 path=rel_path)
+            if is_dir or not stat.S_ISREG(stat_result.st_mode):
+                fmap[rel_path] = SyncManager._props_from_stat(stat_result, is_dir, rel_path)
+                continue
+            file_hash = cache.lookup(rel_path, stat_result, hasher.algo) if cache is not None else None
+            fmap[rel_path] = SyncManager._props_from_stat(stat_result, False, file_hash, hasher.algo)
+            if (file_hash is None) and hash_files:
+                known_blocks, known_size = cache.appended_blocks(rel_path, stat_result, hasher.algo) \
+                    if (cache is not None) and hasher.detect_appends else (None, 0)
+                pending.append((stat_result.st_size, rel_path, full_path, stat_result, known_blocks, known_size))
+            elif (file_hash is not None) and (cache is not None):
+                cache.hits += 1
+        if progress is not None:
+            progress.end(scan_phase)
+            progress.begin(hash_phase, len(pending), sum(item[0] for item in pending))
+        if not pending:
+            return fmap
+        pending.sort(key=lambda item: item[0])
+        chunk_size = max(int(chunk_size or 1), 1)
+        batches = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+        pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        logger.debug(f"Hashing {len(pending)} files in \"{folder}\" with {workers} {executor} workers")
+        with pool_class(max_workers=workers) as pool:
+            futures = {pool.submit(SyncManager._hash_batch, [item[2:3] + item[4:] for item in batch], hasher): batch
+                       for batch in batches}
+            for future in as_completed(futures):
+                if (cancel_event is not None) and cancel_event.is_set():
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    SyncManager._check_cancelled(cancel_event, folder)
+                batch = futures[future]
+                for (_, rel_path, full_path, stat_result, _, _), (file_hash, blocks, error) in zip(batch, future.result()):
+                    if error is not None:
+                        logger.error(f"Error calculating hash for file \"{full_path}\": {error}")
+                        del fmap[rel_path]
+                        continue
+                    fmap[rel_path] = SyncManager._props_from_stat(stat_result, False, file_hash, hasher.algo)
+                    if cache is not None:
+                        cache.misses += 1
+                        cache.store(rel_path, stat_result, file_hash, hasher.algo, blocks)
+                    if progress is not None:
+                        progress.advance(hash_phase, size=stat_result.st_size, path=rel_path)
+        return fmap
+
+    def _scan(self, which: str) -> dict:
+        which = which.lower()
+        watched = self.is_watching(which)
+        snapshot = self._snapshots.get(which)
+        fmap = None
+        if watched:
+            watcher = self._watchers[which]
+            watcher.flush()
+            changes = watcher.journal.drain()
+            if snapshot and snapshot.get("watched") and not changes["overflow"]:
+                try:
+                    fmap = self._scan_incremental(which, snapshot["state"], changes)
+                except BaseException:
+                    # The drained changes are lost, the next scan has to be a full one
+                    self.invalidate_snapshots(which)
+                    raise
+            # Otherwise the changes are discarded, the full scan below sees them
+        if fmap is None:
+            fmap = self.scan_folder(getattr(self, f"_folder_{which}"), self._get_hash_cache(which),
+                                    self._scan_workers, self._scan_executor, self._scan_chunk_size, self._cancel_event,
+                                    self._compare_mode != "quick", self._hasher, self._progress, which.upper())
+        with self._snapshot_lock:
+            self._scan_generation += 1
+            self._snapshots[which] = {"generation": self._scan_generation, "time": datetime.now(), "state": fmap,
+                                      "watched": watched}
+        return fmap
+
+    def _scan_incremental(self, which: str, base_state: dict, changes: dict) -> dict:
+        """
+        Update the last scan snapshot of folder `which` with the changes journaled by its watcher.
+
+        Only the journaled paths, the folders that must be rescanned entirely and the parents of changed paths are
+        read from disk, every other entry is reused from `base_state`.
+        """
+        folder = getattr(self, f"_folder_{which}")
+        cache = self._get_hash_cache(which)
+        hash_files = self._compare_mode != "quick"
+        fmap = dict(base_state)
+        scan_phase = f"scan {which.upper()}"
+        self._progress.begin(scan_phase, len(changes["paths"]))
+
+        def drop_subtree(rel_dir):
+            prefix = rel_dir + os.sep
+            for rel_path in [rel_path for rel_path in fmap if rel_path.startswith(prefix)]:
+                del fmap[rel_path]
+
+        def rescan_path(rel_path):
+            full_path = os.path.join(folder, rel_path)
+            try:
+                stat_result = os.stat(full_path)
+            except FileNotFoundError:
+                if fmap.pop(rel_path, {}).get("type") == "folder":
+                    drop_subtree(rel_path)
+                return
+            is_dir = stat.S_ISDIR(stat_result.st_mode)
+            if (not is_dir) and (fmap.get(rel_path, {}).get("type") == "folder"):
+                drop_subtree(rel_path)
+            try:
+                file_hash = self._get_hash(full_path, rel_path, stat_result, is_dir, cache, hash_files, self._hasher)
+                fmap[rel_path] = self._props_from_stat(stat_result, is_dir, file_hash, self._hasher.algo)
+                self._progress.advance(scan_phase, size=fmap[rel_path]["size"], path=rel_path)
+            except Exception as e:
+                fmap.pop(rel_path, None)
+                logger.error(f"Error calculating hash for {'directory' if is_dir else 'file'} \"{full_path}\": {str(e)}")
+
+        for rel_dir in sorted(changes["folders"]):
+            self._check_cancelled(self._cancel_event, folder)
+            drop_subtree(rel_dir)
+            if not os.path.isdir(os.path.join(folder, rel_dir)):
+                continue  # Removed or moved away, its own entry is updated from the journaled paths
+            for sub_path, full_path, stat_result, is_dir in self.walk_folder(os.path.join(folder, rel_dir), self._cancel_event):
+                rel_path = os.path.join(rel_dir, sub_path)
                 try:
-                    rel_path = os.path.relpath(full_path, folder)
-                    fmap[rel_path] = SyncManager.get_props(full_path, rel_path)
+                    file_hash = self._get_hash(full_path, rel_path, stat_result, is_dir, cache, hash_files,
+                                               self._hasher)
+                    fmap[rel_path] = self._props_from_stat(stat_result, is_dir, file_hash, self._hasher.algo)
+                    self._progress.advance(scan_phase, size=fmap[rel_path]["size"], path=rel_path)
                 except Exception as e:
-                    logger.error(f"Error calculating hash for {'directory' if os.path.isdir(full_path) else 'file'} \"{full_path}\": {str(e)}")
+                    logger.error(f"Error calculating hash for {'directory' if is_dir else 'file'} \"{full_path}\": {str(e)}")
+        parents = set()
+        for rel_path in changes["paths"]:
+            self._check_cancelled(self._cancel_event, folder)
+            if rel_path.endswith(TEMP_SUFFIX):
+                continue
+            rescan_path(rel_path)
+            parents.add(os.path.dirname(rel_path))
+        for rel_dir in parents - {""}:
+            if rel_dir in fmap:
+                rescan_path(rel_dir)
+        self._progress.end(scan_phase)
+        logger.info(f"Folder {which.upper()} updated from the change journal: {len(changes['paths'])} paths, "
+                    f"{len(changes['folders'])} folders rescanned")
+        if cache is not None:
+            cache.prune(fmap.keys())
+            cache.save()
         return fmap
 
-    def get_folder_state(self, which: str):
-        if which.lower() == "a":
-            return self.scan_folder(self._folder_a)
-        if which.lower() == "b":
-            return self.scan_folder(self._folder_b)
+    def is_watching(self, which: str) -> bool:
+        watcher = self._watchers.get(which.lower())
+        return (watcher is not None) and watcher.running
+
+    def start_watching(self):
+        """
+        Start the folder watchers if the watch mode is not "off".
+
+        While a watcher runs, changes to its folder are recorded in a change journal and scans after the first full
+        one only rescan the journaled paths.
+        """
+        if self._watch_mode == "off":
+            return
+        for which in "ab":
+            folder = getattr(self, f"_folder_{which}")
+            if (not folder) or self.is_watching(which):
+                continue
+            journal = ChangeJournal()
+            watcher = create_watcher(folder, journal, self._watch_mode, self._watch_poll_interval,
+                                     self._watch_poll_max_interval)
+            try:
+                watcher.start()
+            except OSError as e:
+                logger.warning(f"Cannot watch folder {which.upper()} with {type(watcher).__name__}, polling instead. Error: {str(e)}")
+                watcher = PollingWatcher(folder, journal, self._watch_poll_interval, self._watch_poll_max_interval)
+                watcher.start()
+            self._watchers[which] = watcher
+            # The journal only covers changes from now on, so the next scan must be a full one
+            self.invalidate_snapshots(which)
+
+    def stop_watching(self):
+        for which in "ab":
+            self._stop_watcher(which)
+
+    def _stop_watcher(self, which: str) -> bool:
+        watcher = self._watchers.pop(which.lower(), None)
+        if watcher is None:
+            return False
+        watcher.stop()
+        return True
+
+    def get_snapshot_generation(self, which: str):
+        """Return the generation number of the last scan of folder `which`, or None if there is no valid snapshot."""
+        snapshot = self._snapshots.get(which.lower())
+        return snapshot["generation"] if snapshot else None
+
+    def invalidate_snapshots(self, which: str = "ab"):
+        """Discard the scan snapshots of the given folders so the next get_folder_state() rescans them."""
+        with self._snapshot_lock:
+            for side in which.lower():
+                self._snapshots.pop(side, None)
+
+    def _scan_both(self) -> list:
+        """
+        Scan folders A and B at the same time and return their maps as [state_a, state_b].
+
+        If either scan fails the other one is cancelled through the shared cancel event and the original error is
+        raised. A cancellation requested by the user raises SyncCancelled.
+        """
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="scan") as pool:
+            futures = [pool.submit(self._scan, "a"), pool.submit(self._scan, "b")]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            errors = [future.exception() for future in futures if future in done and future.exception()]
+            if errors:
+                self._cancel_event.set()
+        if errors:
+            # Prefer the error that caused the cancellation over the SyncCancelled raised by the other side
+            raise next((e for e in errors if not isinstance(e, SyncCancelled)), errors[0])
+        return [future.result() for future in futures]
+
+    def get_folder_state(self, which: str, rescan: bool = False):
+        """
+        Return the state of folder A or B, the last synced common state or the future common state.
+
+        Folder states come from the snapshot taken by the most recent scan (e.g. by prep_sync). The folder is only
+        scanned again when there is no snapshot, the snapshot was invalidated or `rescan` is True.
+        """
+        if which.lower() in ("a", "b"):
+            snapshot = self._snapshots.get(which.lower())
+            if rescan or not snapshot:
+                try:
+                    return self._scan(which)
+                finally:
+                    self.clear_cancel()
+            return snapshot["state"]
         if which.lower().startswith("c"):
             return self.get_latest_history()
         if which.lower().startswith("f"):
@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("SYNC")
+
+
+class SyncProgress:
+    """
+    Progress and throughput counters of a scan or sync, shared by the threads doing the work.
+
+    The work is split in named phases ("scan A", "hash A", "sync copy", ...) that count files and bytes towards
+    optional totals, and several phases can run at the same time. Changes are reported to `callback` as event dicts
+    (see event()) at most every `interval` seconds per phase, and always when a phase begins or ends. The callback
+    runs in the thread doing the work.
+    """
+    DEFAULT_INTERVAL = 0.2
+
+    def __init__(self, callback=None, interval: float = DEFAULT_INTERVAL):
+        self._callback = callback
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._started = time.monotonic()
+
+    def reset(self):
+        """Forget the phases of the previous run."""
+        with self._lock:
+            self._phases = {}
+            self._started = time.monotonic()
+
+    def begin(self, phase: str, total_files: int = None, total_bytes: int = None):
+        now = time.monotonic()
+        with self._lock:
+            self._phases[phase] = {"files": 0, "bytes": 0, "total_files": total_files, "total_bytes": total_bytes,
+                                   "path": None, "start": now, "end": None, "reported": now}
+            event = self._event(phase, now)
+        self._report(event)
+
+    def set_total(self, phase: str, total_files: int = None, total_bytes: int = None):
+        with self._lock:
+            state = self._phases[phase]
+            state["total_files"], state["total_bytes"] = total_files, total_bytes
+
+    def advance(self, phase: str, files: int = 1, size: int = 0, path: str = None):
+        """Count `files` files and `size` bytes as done in `phase`, `path` being the last one."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._phases[phase]
+            state["files"] += files
+            state["bytes"] += size
+            if path is not None:
+                state["path"] = path
+            if now - state["reported"] < self._interval:
+                return
+            state["reported"] = now
+            event = self._event(phase, now)
+        self._report(event)
+
+    def end(self, phase: str):
+        now = time.monotonic()
+        with self._lock:
+            state = self._phases.get(phase)
+            if (state is None) or (state["end"] is not None):
+                return
+            state["end"] = now
+            event = self._event(phase, now)
+        self._report(event)
+
+    def event(self, phase: str) -> dict:
+        """
+        Return the progress of `phase` as a dict with the phase name, the files and bytes done and their totals
+        (None if unknown), the last path, the elapsed seconds, the rates (bytes and files per second), the
+        estimated seconds left (None if unknown) and whether the phase has ended.
+        """
+        with self._lock:
+            return self._event(phase, time.monotonic())
+
+    def _event(self, phase: str, now: float) -> dict:
+        state = self._phases[phase]
+        elapsed = (state["end"] or now) - state["start"]
+        eta = None
+        if state["end"] is not None:
+            eta = 0.0
+        elif state["total_bytes"] and state["bytes"]:
+            eta = elapsed * max(state["total_bytes"] - state["bytes"], 0) / state["bytes"]
+        elif state["total_files"] and state["files"]:
+            eta = elapsed * max(state["total_files"] - state["files"], 0) / state["files"]
+        return {
+            "phase": phase,
+            "files": state["files"],
+            "bytes": state["bytes"],
+            "total_files": state["total_files"],
+            "total_bytes": state["total_bytes"],
+            "path": state["path"],
+            "elapsed": elapsed,
+            "rate": state["bytes"] / elapsed if elapsed > 0 else 0.0,
+            "file_rate": state["files"] / elapsed if elapsed > 0 else 0.0,
+            "eta": eta,
+            "done": state["end"] is not None,
+        }
+
+    def _report(self, event: dict):
+        if self._callback is None:
+            return
+        try:
+            self._callback(event)
+        except Exception as e:
+            logger.error(f"Error in progress callback. Error: {str(e)}")
+
+    def summary(self) -> dict:
+        """Return the timing of the run as {"seconds", "phases": [{"phase", "seconds", "files", "bytes", "rate"}]}."""
+        now = time.monotonic()
+        with self._lock:
+            phases = []
+            for phase, state in self._phases.items():
+                seconds = (state["end"] or now) - state["start"]
+                phases.append({"phase": phase, "seconds": round(seconds, 3), "files": state["files"],
+                               "bytes": state["bytes"], "rate": round(state["bytes"] / seconds, 1) if seconds > 0 else 0.0})
+            return {"seconds": round(now - self._started, 3), "phases": phases}
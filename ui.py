@@ -1,5 +1,7 @@
 import platform
+import queue
 import subprocess
+import threading
 import tkinter as tk
 from datetime import datetime
 from tkinter import ttk
@@ -12,6 +14,7 @@ from PIL import Image, ImageTk
 # import ttkbootstrap as tb
 
 from project_manager import ProjectManager
+from sync_manager import SyncCancelled
 
 load_dotenv()
 DEBUG = bool(os.environ.get("DEBUG", False))
@@ -79,9 +82,14 @@ class AboutDialog(simpledialog.Dialog):
 
 
 class FileTree(ttk.Treeview):
+    BATCH_SIZE = 500  # Items inserted per after() callback
+
     def __init__(self, master, path=None, **kwargs):
         super().__init__(master)
         self.path = path
+        self._state = {}
+        self._children = {}
+        self._generation = 0  # Incremented by clear(), pending batches of an older tree are dropped
         # self.tag_configure('folder', foreground='black', font=("", 10, 'bold'))
         # self.tag_configure('folder_empty', foreground='gray', font=("", 10, "italic"))
         # self.tag_configure('file', foreground='black', font=("", 10))
@@ -101,6 +109,7 @@ class FileTree(ttk.Treeview):
         self.tag_configure("folder", image=self.icon_folder)
         self.tag_configure("delete folder", image=self.icon_delete_folder, foreground="red")
         self.tag_configure("new folder", image=self.icon_new_folder, foreground="green")
+        self.tag_configure("placeholder", foreground="gray")
         # self.tag_configure("unchanged")
         # self.tag_configure("new a")
         # self.tag_configure("new b")
@@ -112,6 +121,7 @@ class FileTree(ttk.Treeview):
         # self.tag_configure("deleted b")
         # self.build_tree("", path)
         self["show"] = "tree"  # remove the header row and make the tree look more like a list
+        self.bind("<<TreeviewOpen>>", self._on_open)
 
     # def build_tree(self, parent, path):
     #     if not path:
@@ -134,21 +144,142 @@ class FileTree(ttk.Treeview):
     #             self.insert(parent, 'end', text=entry, open=True, tags=("file",), image=self.icon_file)
 
     def build_tree_from_state(self, folder_state: dict):
+        """
+        Show `folder_state` (relative path -> props), with the relative paths as item ids.
+
+        Only the top level is inserted, with a placeholder under every folder that has children. A folder is filled
+        the first time it is opened, and large folders are inserted in batches through after() so Tk keeps
+        handling events.
+        """
         self.clear()
-        if not folder_state:
+        self._state = self._item_tags(folder_state or {})
+        self._children = self._index(self._state)
+        self._populate("")
+
+    def update_from_state(self, folder_state: dict):
+        """
+        Show `folder_state` like build_tree_from_state, changing only the items that differ from the state shown.
+
+        Items that were removed, added or re-tagged are updated in place, so open folders, the selection and the
+        scroll position are kept, and the Tk work is proportional to the number of changes. The first fill and
+        changes of more than BATCH_SIZE items rebuild the tree instead, which inserts the items in batches.
+        """
+        new_state = self._item_tags(folder_state or {})
+        old_state = self._state
+        removed = {rel_path for rel_path in old_state if rel_path not in new_state}
+        added = set()
+        retagged = []
+        for rel_path, tag in new_state.items():
+            old_tag = old_state.get(rel_path)
+            if old_tag is None:
+                added.add(rel_path)
+            elif old_tag != tag:
+                if old_tag.endswith("folder") != tag.endswith("folder"):
+                    removed.add(rel_path)  # Changed between file and folder, replace the item
+                    added.add(rel_path)
+                else:
+                    retagged.append(rel_path)
+        if not old_state or (len(removed) + len(added) > self.BATCH_SIZE):
+            self.build_tree_from_state(folder_state)
+            return
+        self._state = new_state
+        for rel_path in retagged:
+            if self.exists(rel_path):
+                self.item(rel_path, tags=(new_state[rel_path],))
+        # Deleting a folder item deletes its children, the deepest paths go first so they still exist
+        for rel_path in sorted(removed, key=lambda rel_path: rel_path.count(os.sep), reverse=True):
+            if self.exists(rel_path):
+                self.delete(rel_path)
+        # Sort the children of each changed folder once
+        added_by_parent = {}
+        for rel_path in added:
+            added_by_parent.setdefault(os.path.dirname(rel_path), []).append(rel_path)
+        parents = {os.path.dirname(rel_path) for rel_path in removed} | added_by_parent.keys()
+        for parent in parents:
+            siblings = [rel_path for rel_path in self._children.get(parent, []) if rel_path not in removed]
+            siblings += added_by_parent.get(parent, [])
+            if siblings:
+                siblings.sort(key=lambda rel_path: self._sort_key(rel_path, new_state))
+                self._children[parent] = siblings
+            else:
+                self._children.pop(parent, None)
+        for parent in sorted(parents, key=lambda rel_path: rel_path.count(os.sep)):
+            if parent and not self.exists(parent):
+                continue  # Inside a folder that is not shown yet
+            shown = self.get_children(parent)
+            if shown and self.tag_has("placeholder", shown[0]):
+                if parent not in self._children:
+                    self.delete(*shown)  # Placeholder of a folder that is now empty
+                continue  # Not filled yet, the folder is filled from the index when opened
+            if parent not in self._children:
+                continue
+            if parent and not shown and not self.item(parent, "open"):
+                self._insert_placeholder(parent)  # Folder was empty
+                continue
+            shown = set(shown)
+            position = 0
+            for rel_path in self._children[parent]:
+                if rel_path in shown:
+                    position += 1
+                elif rel_path in added:
+                    self._insert_item(parent, rel_path, position)
+                    position += 1
+
+    @staticmethod
+    def _item_tags(folder_state: dict) -> dict:
+        return {rel_path: FileTree._item_tag(props) for rel_path, props in folder_state.items()
+                if props["type"] in ("folder", "file")}
+
+    @staticmethod
+    def _sort_key(rel_path: str, state: dict) -> tuple:
+        return not state[rel_path].endswith("folder"), rel_path
+
+    @staticmethod
+    def _index(state: dict) -> dict:
+        """Return a map of parent path -> children paths, folders first then files, each sorted by name."""
+        children = {}
+        for rel_path in state:
+            children.setdefault(os.path.dirname(rel_path), []).append(rel_path)
+        for items in children.values():
+            items.sort(key=lambda rel_path: FileTree._sort_key(rel_path, state))
+        return children
+
+    @staticmethod
+    def _item_tag(props: dict) -> str:
+        state_tag = props.get("tag", "")
+        if props["type"] == "folder":
+            return "new folder" if "new" in state_tag else ("delete folder" if "delete" in state_tag else "folder")
+        return "new file" if "new" in state_tag else ("delete file" if "delete" in state_tag else ("update file" if "update" in state_tag else ("conflict file" if "conflict" in state_tag else "file")))
+
+    def _populate(self, parent: str):
+        self._insert_batch(parent, list(self._children.get(parent, [])), 0, self._generation)
+
+    def _insert_batch(self, parent: str, items: list, start: int, generation: int):
+        if generation != self._generation:
             return
-        directories = sorted([entry for entry in folder_state if folder_state[entry]["type"] == "folder"])
-        files = sorted([entry for entry in folder_state if folder_state[entry]["type"] == "file"])
-        for directory in directories:
-            parent, item = os.path.split(directory)
-            state_tag = folder_state[directory].get("tag", "")
-            item_tag = "new folder" if "new" in state_tag else ("delete folder" if "delete" in state_tag else "folder")
-            self.insert(parent, "end", text=item, open=False, tags=(item_tag,), iid=directory)
-        for file in files:
-            parent, item = os.path.split(file)
-            state_tag = folder_state[file].get("tag", "")
-            item_tag = "new file" if "new" in state_tag else ("delete file" if "delete" in state_tag else ("update file" if "update" in state_tag else ("conflict file" if "conflict" in state_tag else "file")))
-            self.insert(parent, "end", text=item, tags=(item_tag,), iid=file)
+        for rel_path in items[start:start + self.BATCH_SIZE]:
+            # The state may have been updated since the batches were scheduled
+            if (rel_path in self._state) and not self.exists(rel_path) and (not parent or self.exists(parent)):
+                self._insert_item(parent, rel_path, "end")
+        if start + self.BATCH_SIZE < len(items):
+            self.after(1, self._insert_batch, parent, items, start + self.BATCH_SIZE, generation)
+
+    def _insert_item(self, parent: str, rel_path: str, index):
+        self.insert(parent, index, text=os.path.basename(rel_path), open=False, tags=(self._state[rel_path],),
+                    iid=rel_path)
+        if rel_path in self._children:
+            self._insert_placeholder(rel_path)
+
+    def _insert_placeholder(self, parent: str):
+        # Explicit iid, the ids generated by Tk (I001, ...) could be the relative path of a top level item
+        self.insert(parent, "end", text="...", tags=("placeholder",), iid=parent + "\0")
+
+    def _on_open(self, event=None):
+        item = self.focus()
+        children = self.get_children(item)
+        if children and self.tag_has("placeholder", children[0]):
+            self.delete(*children)
+            self._populate(item)
 
     def get_full_path(self, item):
         parts = []
@@ -158,6 +289,9 @@ class FileTree(ttk.Treeview):
         return os.path.join(self.path, *parts)
 
     def clear(self):
+        self._generation += 1
+        self._state = {}
+        self._children = {}
         self.delete(*self.get_children())
 
 
@@ -312,6 +446,10 @@ class MainApp(tk.Tk):
         self.s_folder_a = tk.StringVar()
         self.s_folder_b = tk.StringVar()
         self.s_status = tk.StringVar()
+        # Background task (see run_task)
+        self._task = None
+        self._task_project = None
+        self._task_queue = queue.Queue()
         # Create menu bar
         self.menubar = tk.Menu(self, tearoff=0)
         self.filemenu = tk.Menu(self.menubar, tearoff=0)
@@ -343,13 +481,18 @@ class MainApp(tk.Tk):
         self.frame_folder_a.grid(row=0, column=0, sticky="NSEW")
         self.frame_common.grid(row=0, column=1, sticky="NSEW")
         self.frame_folder_b.grid(row=0, column=2, sticky="NSEW")
-        self.statusbar = tk.Label(self, textvariable=self.s_status, bd=1, relief=tk.SUNKEN, anchor=tk.S, justify=tk.LEFT)
-        self.statusbar.grid(row=1, column=0, columnspan=3, sticky="NSEW")
+        self.statusframe = ttk.Frame(self)
+        self.statusframe.grid(row=1, column=0, columnspan=3, sticky="NSEW")
+        self.statusbar = tk.Label(self.statusframe, textvariable=self.s_status, bd=1, relief=tk.SUNKEN, anchor=tk.S, justify=tk.LEFT)
+        self.statusbar.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.cancel_button = ttk.Button(self.statusframe, text="Cancel", command=self.cancel_task)
+        self.progressbar = ttk.Progressbar(self.statusframe, length=200, maximum=100)
 
         self.grid_columnconfigure((0, 1, 2), weight=1, uniform="column")
         self.grid_rowconfigure(0, weight=1)
         self.grid_rowconfigure(1, weight=0)
 
+        self.protocol("WM_DELETE_WINDOW", self.quit)
         self.update_idletasks()
         self.geometry("900x400")
 
@@ -360,11 +503,134 @@ class MainApp(tk.Tk):
         messagebox.showinfo("Not Implemented", "This feature is not yet implemented.")
 
     def quit(self):
+        if self.busy:
+            if not messagebox.askyesno("Exit", "A scan or sync is running.\nDo you want to cancel it and exit?"):
+                return
+            self.cancel_task()
+            self._task.join()
         self.ask_to_save_changes()
         super().quit()
 
+    @property
+    def busy(self):
+        return (self._task is not None) and self._task.is_alive()
+
+    def run_task(self, status: str, func, on_done=None):
+        """
+        Run `func` in a worker thread, keeping the window responsive.
+
+        The worker also reads the states of folders A and B afterwards, since a sync invalidates the scan snapshots
+        and rescanning large folders on the Tk thread would freeze the window. The result and the states come back
+        through a queue polled with after(), then `on_done(result, states)` runs on the Tk thread. Errors are shown
+        to the user. Only one task runs at a time, the menus are disabled meanwhile.
+        """
+        if self.busy:
+            return
+        project = self.project_manager.active_project
+
+        def worker():
+            try:
+                kind, value = "done", func()
+            except BaseException as e:
+                kind, value = "error", e
+            states = {}
+            if (project is not None) and not isinstance(value, SyncCancelled):
+                try:
+                    states = {which: project.get_folder_state(which) for which in "ab"}
+                except BaseException as e:
+                    if kind == "done":
+                        kind, value = "error", e
+            if project is not None:
+                project.clear_cancel()  # A cancellation requested too late for the task must not stop the next one
+            self._task_queue.put((kind, (value, states)))
+
+        self._task = threading.Thread(target=worker, name="MainApp task", daemon=True)
+        self._task_project = project
+        if self._task_project:
+            self._task_project.add_progress_listener(self._on_task_progress)
+        self._task.start()
+        self.cancel_button.config(state=tk.NORMAL)
+        self.cancel_button.pack(side=tk.RIGHT)
+        self.progressbar.config(mode="indeterminate", value=0)
+        self.progressbar.pack(side=tk.RIGHT, padx=4)
+        self.progressbar.start()
+        self.update_ui()
+        self.s_status.set(status)
+        self.after(100, self._poll_task, on_done)
+
+    def _on_task_progress(self, event: dict):
+        # Called from the worker thread, the event is shown by _poll_task
+        self._task_queue.put(("progress", event))
+
+    def _poll_task(self, on_done):
+        progress = None
+        while True:
+            try:
+                kind, value = self._task_queue.get_nowait()
+            except queue.Empty:
+                if progress is not None:
+                    self.show_progress(progress)
+                self.after(100, self._poll_task, on_done)
+                return
+            if kind != "progress":
+                break
+            progress = value
+        if self._task_project:
+            self._task_project.remove_progress_listener(self._on_task_progress)
+        self._task = None
+        self._task_project = None
+        self.cancel_button.pack_forget()
+        self.progressbar.stop()
+        self.progressbar.pack_forget()
+        self.update_ui()
+        value, states = value
+        if kind == "error":
+            if isinstance(value, SyncCancelled):
+                self.s_status.set("Cancelled.")
+            else:
+                messagebox.showerror("Error", str(value))
+            self.refresh_folder_frames(states=states)
+            return
+        if on_done is not None:
+            on_done(value, states)
+
+    def show_progress(self, event: dict):
+        if self.cancel_button.instate([tk.DISABLED]):
+            return  # Keep showing that the task is being cancelled
+        total = event["total_bytes"] or event["total_files"]
+        done = event["bytes"] if event["total_bytes"] else event["files"]
+        if total:
+            self.progressbar.stop()
+            self.progressbar.config(mode="determinate", value=min(100.0 * done / total, 100.0))
+        elif str(self.progressbar.cget("mode")) != "indeterminate":
+            self.progressbar.config(mode="indeterminate", value=0)
+            self.progressbar.start()
+        self.s_status.set(self.format_progress(event))
+
+    @staticmethod
+    def format_progress(event: dict) -> str:
+        files = f"{event['files']}" + (f"/{event['total_files']}" if event["total_files"] else "")
+        size = f"{event['bytes'] / 1e6:.1f}" + (f"/{event['total_bytes'] / 1e6:.1f}" if event["total_bytes"] else "")
+        text = f"{event['phase'][:1].upper()}{event['phase'][1:]}: {files} files, {size} MB, {event['rate'] / 1e6:.1f} MB/s"
+        if event["eta"] is not None and not event["done"]:
+            text += f", {int(event['eta']) // 60}:{int(event['eta']) % 60:02d} left"
+        if event["path"] and not event["done"]:
+            text += f" - {event['path']}"
+        return text
+
+    def cancel_task(self):
+        if self.busy and self._task_project:
+            self.cancel_button.config(state=tk.DISABLED)
+            self.s_status.set("Cancelling...")
+            self._task_project.cancel()
+
     def update_ui(self):
-        if self.project_manager.active_project:
+        busy_state = tk.DISABLED if self.busy else tk.NORMAL
+        for label in ("New Project...", "Open Project...", "Save Project...", "Save Project As...", "Delete Project..."):
+            self.filemenu.entryconfig(label, state=busy_state)
+        if self.busy:
+            self.menubar.entryconfig("Sync", state=tk.DISABLED)
+        elif self.project_manager.active_project:
             self.s_project_name.set(self.project_manager.active_project.project_name)
             self.s_folder_a.set(self.project_manager.active_project.folder_a)
             self.s_folder_b.set(self.project_manager.active_project.folder_b)
@@ -379,7 +645,8 @@ class MainApp(tk.Tk):
             self.menubar.entryconfig("Sync", state=tk.DISABLED)
             self.s_status.set("No project selected.")
 
-    def refresh_folder_frames(self, which: str = "abc", tags=False):
+    def refresh_folder_frames(self, which: str = "abc", tags=False, states: dict = None):
+        """Refresh the panes in `which`. With `states` (see run_task), panes A and B missing from it are left as is."""
         if not self.project_manager.active_project:
             self.frame_folder_a.filetree.clear()
             self.frame_folder_a.path = ""
@@ -387,17 +654,18 @@ class MainApp(tk.Tk):
             self.frame_folder_b.path = ""
             self.frame_common.filetree.clear()
             return
-        if "a" in which.lower():
-            self.frame_folder_a.filetree.build_tree_from_state(self.project_manager.active_project.get_folder_state("a"))
-            self.frame_folder_a.path = self.project_manager.active_project.folder_a
-        if "b" in which.lower():
-            self.frame_folder_b.filetree.build_tree_from_state(self.project_manager.active_project.get_folder_state("b"))
-            self.frame_folder_b.path = self.project_manager.active_project.folder_b
+        for side, frame, folder in (("a", self.frame_folder_a, self.project_manager.active_project.folder_a),
+                                    ("b", self.frame_folder_b, self.project_manager.active_project.folder_b)):
+            if (side not in which.lower()) or ((states is not None) and (side not in states)):
+                continue
+            state = states[side] if states is not None else self.project_manager.active_project.get_folder_state(side)
+            frame.filetree.update_from_state(state)
+            frame.path = folder
         if "c" in which.lower():
             if tags:
-                self.frame_common.filetree.build_tree_from_state(self.project_manager.active_project.get_future_common_state())
+                self.frame_common.filetree.update_from_state(self.project_manager.active_project.get_future_common_state())
             else:
-                self.frame_common.filetree.build_tree_from_state(self.project_manager.active_project.get_folder_state("common"))
+                self.frame_common.filetree.update_from_state(self.project_manager.active_project.get_folder_state("common"))
 
     def create_new_project(self):
         self.ask_to_save_changes()
@@ -428,6 +696,7 @@ class MainApp(tk.Tk):
             self.project_manager.active_project = dialog.selection
             self.refresh_folder_frames()
             self.update_ui()
+            self.check_interrupted_sync()
 
     def ask_to_save_changes(self):
         if not self.project_manager.active_project:
@@ -486,8 +755,10 @@ class MainApp(tk.Tk):
         self.open_folder(self.project_manager.active_project.folder_b)
 
     def prep_sync(self):
-        self.project_manager.active_project.prep_sync()
-        self.refresh_folder_frames(tags=True)
+        self.run_task("Preparing sync...", self.project_manager.active_project.prep_sync, self._prep_sync_done)
+
+    def _prep_sync_done(self, result, states):
+        self.refresh_folder_frames(tags=True, states=states)
         self.update_ui()
 
     def handle_conflicts(self):
@@ -498,9 +769,19 @@ class MainApp(tk.Tk):
             for i, k in enumerate(conflicts.keys()):
                 self.project_manager.active_project.modify_action(k, " ".join(conflicts[k].split()[0:2] + [dialog.result[i]]))
 
+    def check_interrupted_sync(self):
+        project = self.project_manager.active_project
+        if not project or not project.get_interrupted_sync():
+            return
+        if messagebox.askyesno("Resume Sync", "The last sync of this project did not finish.\nDo you want to resume it?"):
+            self.run_task("Resuming sync...", project.resume_sync, self._sync_done)
+
     def sync_now(self):
-        self.project_manager.active_project.execute_sync()
-        self.refresh_folder_frames()
+        self.run_task("Syncing...", self.project_manager.active_project.execute_sync, self._sync_done)
+
+    def _sync_done(self, result, states):
+        self.refresh_folder_frames(states=states)
+        self.update_ui()
 
     def show_about_dialog(self):
         AboutDialog(self)